@@ -1,5 +1,6 @@
 from fastapi import FastAPI
 from routes import router as api_router
+from controllers import dispatcher
 
 
 app = FastAPI(
@@ -11,6 +12,11 @@ app = FastAPI(
 
 app.include_router(api_router)
 
+
+@app.on_event("startup")
+async def start_dispatcher():
+    dispatcher.start()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=3000)
@@ -1,8 +1,13 @@
 
 from fastapi import HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError, ExpiredSignatureError
+from jose import jwk, jwt, JWTError, ExpiredSignatureError
 import requests
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 from pstore import load_parameters
 
 
@@ -21,25 +26,95 @@ COGNITO_CLIENT_ID = parameters.get("cognitoclientid")
 JWKS_URL = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}/.well-known/jwks.json"
 ISSUER = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}"
 
-jwks = requests.get(JWKS_URL).json()
+# Verified claims per token, so repeat requests skip the RS256 check. Entries
+# expire with the token; the least recently used go first once full.
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 1024))
+# An unknown kid triggers a JWKS reload (key rotation), at most this often;
+# after a failed fetch, retried sooner
+JWKS_MIN_REFRESH = float(os.environ.get("JWKS_MIN_REFRESH", 60))
+JWKS_RETRY_INTERVAL = float(os.environ.get("JWKS_RETRY_INTERVAL", 5))
+
+_lock = threading.Lock()
+_token_cache = OrderedDict()
+# Only unknown-kid requests wait on a JWKS fetch; _keys is replaced whole, so
+# readers never need a lock
+_refresh_lock = threading.Lock()
+_keys = {}
+_keys_loaded_at = None
+_keys_failed_at = None
+
+
+def _refresh_keys():
+    global _keys, _keys_loaded_at, _keys_failed_at
+    with _refresh_lock:
+        now = time.monotonic()
+        if _keys_loaded_at is not None and now - _keys_loaded_at < JWKS_MIN_REFRESH:
+            return
+        if _keys_failed_at is not None and now - _keys_failed_at < JWKS_RETRY_INTERVAL:
+            return
+        try:
+            jwks = requests.get(JWKS_URL, timeout=5).json()
+            _keys = {k["kid"]: jwk.construct(k, "RS256") for k in jwks["keys"]}
+            _keys_loaded_at, _keys_failed_at = time.monotonic(), None
+        except Exception as e:
+            _keys_failed_at = time.monotonic()
+            print(f"JWKS fetch failed: {e}")
+
+
+def signing_key(kid):
+    key = _keys.get(kid)
+    if key is None:
+        _refresh_keys()
+        key = _keys.get(kid)
+    if key is None:
+        raise HTTPException(status_code=401, detail="Invalid token: unknown signing key")
+    return key
+
+
+def _cached_claims(digest):
+    with _lock:
+        claims = _token_cache.get(digest)
+        if claims is None:
+            return None
+        if claims["exp"] <= time.time():
+            del _token_cache[digest]
+            raise HTTPException(status_code=401, detail="Token expired")
+        _token_cache.move_to_end(digest)
+        return claims
+
 
+def _cache_claims(digest, claims):
+    if "exp" not in claims:
+        return
+    with _lock:
+        _token_cache[digest] = claims
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
 
 
 def verify_token(token: str):
+    digest = hashlib.sha256(token.encode()).digest()
+    claims = _cached_claims(digest)
+    if claims is not None:
+        return claims
+
     try:
+        key = signing_key(jwt.get_unverified_header(token).get("kid"))
         claims = jwt.decode(
             token,
-            jwks,
+            key,
             algorithms=["RS256"],
             audience=COGNITO_CLIENT_ID,
             issuer=ISSUER,
         )
-        return claims
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except JWTError as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
 
+    _cache_claims(digest, claims)
+    return claims
+
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if not credentials or credentials.scheme.lower() != "bearer":
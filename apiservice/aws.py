@@ -0,0 +1,23 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
+
+
+# boto3 is blocking, so the API runs every AWS call on this executor instead of
+# the event loop. Its size matches the clients' connection pools: a thread
+# never waits for a connection, and the pools never open more than the
+# executor can use.
+AWS_MAX_CONCURRENCY = int(os.environ.get("AWS_MAX_CONCURRENCY", 32))
+
+AWS_CONFIG = Config(max_pool_connections=AWS_MAX_CONCURRENCY)
+
+_executor = ThreadPoolExecutor(max_workers=AWS_MAX_CONCURRENCY, thread_name_prefix="aws")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Await a blocking call (boto3, ffprobe) without stalling other requests."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
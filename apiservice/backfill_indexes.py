@@ -0,0 +1,44 @@
+"""One-off backfill so items created before the listing indexes appear in them.
+
+Sets catalog (admin listing index), filename_lower (case-insensitive search) and
+a non-empty owner (index keys can't be empty strings) on every item missing
+them. Safe to run more than once.
+
+    python backfill_indexes.py
+"""
+from models import table, CATALOG
+
+
+def backfill():
+    updated = 0
+    kwargs = {}
+    while True:
+        resp = table.scan(**kwargs)
+        for item in resp.get("Items", []):
+            fields = {}
+            if item.get("catalog") != CATALOG:
+                fields["catalog"] = CATALOG
+            if "filename_lower" not in item and item.get("filename"):
+                fields["filename_lower"] = item["filename"].lower()
+            if not item.get("owner"):
+                fields["owner"] = "anonymous"
+            if not fields:
+                continue
+
+            names = {f"#k{i}": name for i, name in enumerate(fields)}
+            values = {f":v{i}": value for i, value in enumerate(fields.values())}
+            table.update_item(
+                Key={"user_id": item["user_id"], "video_id": item["video_id"]},
+                UpdateExpression="SET " + ", ".join(f"#k{i} = :v{i}" for i in range(len(fields))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+            updated += 1
+
+        if "LastEvaluatedKey" not in resp:
+            return updated
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+if __name__ == "__main__":
+    print(f"Backfilled {backfill()} item(s)")
@@ -1,9 +1,10 @@
 import json
 from fastapi import APIRouter, HTTPException, Request, BackgroundTasks
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from models import (
-    create_video, get_video_by_id, list_videos, update_status, remove_video, all_videos, update_status_progress
+    create_video, get_video_by_id, remove_video, update_status_progress,
+    list_video_page, CATALOG
 )
 import subprocess
 import re
@@ -11,11 +12,16 @@ import ffmpeg
 import tempfile
 import os
 import uuid
+import html
+import base64
 import boto3
 
 from pstore import load_parameters
+from profiles import resolve_profile
+from dispatcher import FairShareDispatcher
+from aws import AWS_CONFIG, run_blocking
 
-sqs = boto3.client('sqs', region_name='ap-southeast-2')
+sqs = boto3.client('sqs', region_name='ap-southeast-2', config=AWS_CONFIG)
 QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n11715910-a2"
 
 router = APIRouter()
@@ -29,7 +35,29 @@ S3_BUCKET = parameters.get("s3bucket")
 
 
 
-s3_client = boto3.client("s3", region_name=AWS_REGION)
+s3_client = boto3.client("s3", region_name=AWS_REGION, config=AWS_CONFIG)
+
+# Priority lanes. Cost is estimated in "1080p-seconds" of encode work and a job
+# goes to the first lane whose limit it fits under; unset lanes share QUEUE_URL.
+LANE_QUEUES = {
+    "small": os.environ.get("QUEUE_URL_SMALL", QUEUE_URL),
+    "medium": os.environ.get("QUEUE_URL_MEDIUM", QUEUE_URL),
+    "large": os.environ.get("QUEUE_URL_LARGE", QUEUE_URL),
+}
+LANE_LIMITS = (
+    ("small", float(os.environ.get("LANE_LIMIT_SMALL", 120))),
+    ("medium", float(os.environ.get("LANE_LIMIT_MEDIUM", 1800))),
+)
+dispatcher = FairShareDispatcher(sqs, LANE_QUEUES, QUEUE_URL)
+
+# Relative encode cost of each profile against the default
+PROFILE_COST = {"preview/fast": 0.3, "archive/small": 4.0, "web/vp9": 2.0, "audio/aac": 0.05}
+# Used when the source can't be probed: roughly an 8 Mbit/s 1080p source
+BYTES_PER_COST_UNIT = 1_000_000
+
+RENDITION_CONTAINERS = {"mp4", "mkv", "mov", "webm"}
+MAX_RENDITIONS = 8
+BITRATE_PATTERN = re.compile(r"^\d+[kM]?$")
 
 
 def transcode_video_file(input_path, output_path, output_format="mp4"):
@@ -47,12 +75,59 @@ def transcode_video_file(input_path, output_path, output_format="mp4"):
 
 
 
-def get_all_videos(user_id=None):
-    if user_id:
-        videos = list_videos(user_id)
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(partition, value, key):
+    # the partition is kept so a cursor is only ever resumed on the query that made it
+    cursor = {"index": partition, "value": value, "key": key}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+
+def decode_cursor(cursor, partition, value):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if decoded["index"] != partition or decoded["value"] != value:
+            raise HTTPException(status_code=400, detail="Cursor does not match these filters")
+        return decoded["key"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def get_video_page(current_user, limit=10, cursor=None, sort_by="created_at", order="desc",
+                   status=None, owner=None, search=None):
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+    # Every listing index is ordered by created_at; other orders would mean
+    # reading the whole partition on each request
+    if sort_by != "created_at":
+        raise HTTPException(status_code=400, detail="Videos can only be sorted by created_at")
+
+    # Read from the narrowest index the filters allow; the rest become filter expressions
+    if current_user["role"] != "admin":
+        partition, value, owner = "user_id", current_user["id"], None
+    elif owner:
+        partition, value, owner = "owner", owner, None
+    elif status:
+        partition, value, status = "status", status, None
     else:
-        videos = all_videos()
-    return jsonable_encoder(videos)
+        partition, value = "catalog", CATALOG
+
+    start = decode_cursor(cursor, partition, value) if cursor else None
+    items, next_key = list_video_page(
+        partition, value, limit, order == "desc", start, status=status, owner=owner, search=search
+    )
+    next_cursor = encode_cursor(partition, value, next_key) if next_key else None
+
+    # Presigning is local but may refresh credentials, so it stays on this (executor) thread
+    for v in items:
+        if v.get("poster_key"):
+            v["poster_url"] = s3_client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": S3_BUCKET, "Key": v["poster_key"]},
+                ExpiresIn=3600
+            )
+
+    return {"limit": limit, "next_cursor": next_cursor, "items": jsonable_encoder(items)}
 
 
 async def upload_video(request: Request, current_user: dict):
@@ -64,13 +139,15 @@ async def upload_video(request: Request, current_user: dict):
 
     object_key = f"uploads/{current_user['id']}/{filename}"
 
-    presigned_url = s3_client.generate_presigned_url(
+    presigned_url = await run_blocking(
+        s3_client.generate_presigned_url,
         "put_object",
         Params={"Bucket": S3_BUCKET, "Key": object_key, "ContentType": content_type},
         ExpiresIn=3600
     )
 
-    video_record = create_video(
+    video_record = await run_blocking(
+        create_video,
         filename=filename,
         filepath=object_key,
         owner=current_user["username"],
@@ -83,19 +160,98 @@ async def upload_video(request: Request, current_user: dict):
 
 
 
+def estimate_cost(input_key, profile_name=None, renditions=None):
+    cost = None
+    try:
+        source_url = s3_client.generate_presigned_url(
+            "get_object", Params={"Bucket": S3_BUCKET, "Key": input_key}, ExpiresIn=300
+        )
+        info = ffmpeg.probe(source_url, timeout=10)
+        duration = float(info["format"]["duration"])
+        video = next((st for st in info["streams"] if st.get("codec_type") == "video"), None)
+        scale = int(video["width"]) * int(video["height"]) / (1920 * 1080) if video else 0
+        cost = duration * max(scale, 0.1)
+    except Exception as e:
+        print(f"Could not probe {input_key}, estimating cost from size: {e}")
+
+    if cost is None:
+        try:
+            size = s3_client.head_object(Bucket=S3_BUCKET, Key=input_key)["ContentLength"]
+        except Exception:
+            size = 0
+        cost = size / BYTES_PER_COST_UNIT
+
+    if renditions:
+        return cost * len(renditions)
+    return cost * PROFILE_COST.get(profile_name, 1.0)
+
+
+def choose_lane(cost):
+    for lane, limit in LANE_LIMITS:
+        if cost <= limit:
+            return lane
+    return "large"
+
+
+def validate_renditions(renditions):
+    if not isinstance(renditions, list) or not 0 < len(renditions) <= MAX_RENDITIONS:
+        raise HTTPException(status_code=400, detail=f"renditions must be a list of 1-{MAX_RENDITIONS} entries")
+
+    cleaned, names = [], set()
+    for r in renditions:
+        if not isinstance(r, dict):
+            raise HTTPException(status_code=400, detail="Each rendition must be an object")
+        name = str(r.get("name") or f"{r.get('height')}p")
+        height = r.get("height")
+        video_bitrate = str(r.get("video_bitrate", ""))
+        audio_bitrate = str(r.get("audio_bitrate", "128k"))
+        container = r.get("format", "mp4")
+
+        if not isinstance(height, int) or not 0 < height <= 4320:
+            raise HTTPException(status_code=400, detail=f"Invalid height for rendition {name}")
+        if not BITRATE_PATTERN.match(video_bitrate) or not BITRATE_PATTERN.match(audio_bitrate):
+            raise HTTPException(status_code=400, detail=f"Invalid bitrate for rendition {name}")
+        if not isinstance(container, str) or container not in RENDITION_CONTAINERS:
+            raise HTTPException(status_code=400, detail=f"Unsupported container for rendition {name}")
+        if not re.match(r"^[\w-]+$", name) or name in names:
+            raise HTTPException(status_code=400, detail=f"Invalid or duplicate rendition name {name}")
+
+        names.add(name)
+        cleaned.append({
+            "name": name,
+            "height": height,
+            "video_bitrate": video_bitrate,
+            "audio_bitrate": audio_bitrate,
+            "format": container,
+        })
+    return cleaned
+
+
 async def transcode_video(video_id, request: Request, background_tasks: BackgroundTasks, current_user: dict):
     data = await request.json()
-    output_format = data.get("format")
+    renditions = data.get("renditions")
+    output_format = "abr" if renditions else data.get("format")
     if not output_format:
         raise HTTPException(status_code=400, detail="Output format is required")
 
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    profile_name = None
+    if not renditions:
+        try:
+            profile_name, _, output_format = resolve_profile(data.get("profile"), output_format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    video = await run_blocking(get_video_by_id, current_user['role'], current_user['id'], video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
     if video["owner"] != current_user["username"] and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to transcode this video")
 
+    # Checked before the source is probed; held jobs are keyed by output format
+    if output_format in video.get("pending_jobs", {}):
+        raise HTTPException(status_code=409, detail=f"Video already has a queued {output_format} transcode job")
+
     input_key = video["filepath"]
     base_name, _ = os.path.splitext(video["filename"])
     # output_key = f"transcoded/{base_name}_{output_format}.{output_format}"
@@ -108,19 +264,39 @@ async def transcode_video(video_id, request: Request, background_tasks: Backgrou
         "input_key": input_key,
         "filename": base_name,
         "output_format": output_format,
-        "user_id": current_user["id"]
+        # the owner's, so status updates land on the item even when an admin transcodes it
+        "user_id": video["user_id"]
     }
+    if profile_name:
+        message["profile"] = profile_name
+
+    # One message for the whole ladder so the worker decodes the source once
+    if renditions:
+        message["job_type"] = "ladder"
+        message["renditions"] = validate_renditions(renditions)
+
+    cost = await run_blocking(estimate_cost, input_key, profile_name, message.get("renditions"))
+    message["lane"] = choose_lane(cost)
+    message["estimated_cost"] = round(cost, 1)
 
-    # Send to SQS
-    sqs.send_message(QueueUrl=QUEUE_URL, MessageBody=json.dumps(message))
+    # Held per user and released to the lane queue by the fair-share dispatcher
+    position = await run_blocking(dispatcher.submit, message)
+    if position is None:
+        # another request for the same format got there first
+        raise HTTPException(status_code=409, detail=f"Video already has a queued {output_format} transcode job")
 
-    update_status(current_user["id"], video_id, status="transcoding")
-    return {"message": "Transcoding started", "video_id": video_id}
+    return {"message": "Transcoding queued", "video_id": video_id, "lane": message["lane"], "position": position}
+
+
+def queue_depths(current_user: dict):
+    if current_user["role"] == "admin":
+        return dispatcher.depths()
+    return dispatcher.depths(current_user["id"])
 
 
 
 async def delete_video(video_id, current_user: dict):
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    video = await run_blocking(get_video_by_id, current_user['role'], current_user['id'], video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
@@ -128,11 +304,11 @@ async def delete_video(video_id, current_user: dict):
         raise HTTPException(status_code=403, detail="Not authorized to modify this video")
 
     try:
-        s3_client.delete_object(Bucket=S3_BUCKET, Key=video["filepath"])
+        await run_blocking(s3_client.delete_object, Bucket=S3_BUCKET, Key=video["filepath"])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete video: {str(e)}")
 
-    result = remove_video(current_user['role'],current_user["id"], video_id)
+    result = await run_blocking(remove_video, current_user['role'], current_user["id"], video_id)
     return {"message": "Video deleted" if result else "Failed to delete video"}
 
 
@@ -154,3 +330,77 @@ def download_video(video_id, current_user: dict):
         return {"download_url": presigned_url}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Could not generate download link: {str(e)}")
+
+
+
+def get_playlist(video_id, current_user: dict):
+    """Return the HLS/DASH manifest with every segment URL presigned."""
+    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    if video["owner"] != current_user["username"] and current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to view this video")
+
+    playlist_key = video.get("playlist_key")
+    if not playlist_key:
+        raise HTTPException(status_code=404, detail="Video has no playlist")
+
+    prefix = playlist_key.rsplit("/", 1)[0]
+
+    def presign(name):
+        return s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": f"{prefix}/{name}"},
+            ExpiresIn=3600
+        )
+
+    try:
+        manifest = s3_client.get_object(Bucket=S3_BUCKET, Key=playlist_key)["Body"].read().decode()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not load playlist: {str(e)}")
+
+    if playlist_key.endswith(".m3u8"):
+        lines = [
+            line if not line.strip() or line.startswith("#") else presign(line.strip())
+            for line in manifest.splitlines()
+        ]
+        return Response("\n".join(lines) + "\n", media_type="application/vnd.apple.mpegurl")
+
+    manifest = re.sub(
+        r'(media|sourceURL)="([^"]+)"',
+        lambda m: f'{m.group(1)}="{html.escape(presign(m.group(2)))}"',
+        manifest
+    )
+    return Response(manifest, media_type="application/dash+xml")
+
+
+def get_sprite_index(video_id, current_user: dict):
+    """Return the seek-preview WebVTT index with every sprite sheet URL presigned."""
+    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    if video["owner"] != current_user["username"] and current_user["role"] != "admin":
+        raise HTTPException(status_code=403, detail="Not authorized to view this video")
+
+    sprites_key = video.get("sprites_key")
+    if not sprites_key:
+        raise HTTPException(status_code=404, detail="Video has no previews")
+
+    prefix = sprites_key.rsplit("/", 1)[0]
+
+    def presign(match):
+        url = s3_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": f"{prefix}/{match.group(1)}"},
+            ExpiresIn=3600
+        )
+        return f"{url}#xywh="
+
+    try:
+        index = s3_client.get_object(Bucket=S3_BUCKET, Key=sprites_key)["Body"].read().decode()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Could not load previews: {str(e)}")
+
+    return Response(re.sub(r"^(sprite_\d+\.jpg)#xywh=", presign, index, flags=re.M), media_type="text/vtt")
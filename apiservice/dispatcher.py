@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from models import set_pending_job, claim_pending_job, held_jobs
+from aws import run_blocking
+
+
+# How often the dispatcher tops up the lane queues, and how many visible
+# messages it lets build up in each before holding jobs back
+DISPATCH_INTERVAL = float(os.environ.get("DISPATCH_INTERVAL", 1))
+DISPATCH_TARGET_DEPTH = int(os.environ.get("DISPATCH_TARGET_DEPTH", 10))
+# How often held jobs are reloaded from DynamoDB, picking up those a crashed
+# or scaled-in replica was holding in memory
+RECONCILE_INTERVAL = float(os.environ.get("DISPATCH_RECONCILE_INTERVAL", 60))
+
+# Optional per-user shares, e.g. {"<user_id>": 3}; everyone else gets 1
+FAIR_SHARE_WEIGHTS = json.loads(os.environ.get("FAIR_SHARE_WEIGHTS", "{}"))
+
+
+class FairShareDispatcher:
+    """Holds transcode jobs per user and releases them to SQS round-robin.
+
+    Jobs are persisted on the video item (pending_jobs, one per output format)
+    when submitted, so they survive a restart, and released with a conditional
+    update so only one API replica ever sends a given job.
+    """
+
+    def __init__(self, sqs, lane_queues, default_queue):
+        self.sqs = sqs
+        self.lane_queues = lane_queues
+        self.default_queue = default_queue
+        self.pending = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+        self.task = None
+
+    def _enqueue(self, message, front=False):
+        user_id = message["user_id"]
+        if user_id not in self.pending:
+            self.pending[user_id] = deque()
+            self.order.append(user_id)
+        if front:
+            self.pending[user_id].appendleft(message)
+        else:
+            self.pending[user_id].append(message)
+
+    def submit(self, message):
+        """Hold message for release; its position in the user's queue, or None if that format is already held."""
+        message = {**message, "submitted_at": time.time()}
+        if not set_pending_job(message["user_id"], message["video_id"], message["output_format"], json.dumps(message)):
+            return None
+        with self.lock:
+            self._enqueue(message)
+            return len(self.pending[message["user_id"]])
+
+    def depths(self, user_id=None):
+        now = time.time()
+        with self.lock:
+            return {
+                uid: {
+                    "pending": len(jobs),
+                    "oldest_wait_seconds": round(now - jobs[0]["submitted_at"], 1) if jobs else 0,
+                    "weight": FAIR_SHARE_WEIGHTS.get(uid, 1),
+                }
+                for uid, jobs in self.pending.items()
+                if user_id is None or uid == user_id
+            }
+
+    def _queue_for(self, message):
+        return self.lane_queues.get(message.get("lane"), self.default_queue)
+
+    def _free_capacity(self):
+        capacity = {}
+        for queue_url in set(self.lane_queues.values()) | {self.default_queue}:
+            attrs = self.sqs.get_queue_attributes(
+                QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+            )
+            visible = int(attrs["Attributes"].get("ApproximateNumberOfMessages", 0))
+            capacity[queue_url] = max(0, DISPATCH_TARGET_DEPTH - visible)
+        return capacity
+
+    def _pick(self, capacity):
+        """Take jobs user by user, up to each user's weight per turn, while lanes have room."""
+        picked = []
+        with self.lock:
+            released = True
+            while released and any(capacity.values()):
+                released = False
+                for _ in range(len(self.order)):
+                    user_id = self.order[0]
+                    self.order.rotate(-1)
+                    jobs = self.pending[user_id]
+                    for _ in range(FAIR_SHARE_WEIGHTS.get(user_id, 1)):
+                        if not jobs or not capacity[self._queue_for(jobs[0])]:
+                            break
+                        message = jobs.popleft()
+                        capacity[self._queue_for(message)] -= 1
+                        picked.append(message)
+                        released = True
+
+            for user_id in [uid for uid, jobs in self.pending.items() if not jobs]:
+                del self.pending[user_id]
+                self.order.remove(user_id)
+        return picked
+
+    def release(self):
+        if not self.order:
+            return 0
+
+        sent = 0
+        for message in self._pick(self._free_capacity()):
+            if not claim_pending_job(message["user_id"], message["video_id"], message["output_format"]):
+                continue  # deleted, or released by another replica
+            body = {k: v for k, v in message.items() if k != "submitted_at"}
+            try:
+                self.sqs.send_message(QueueUrl=self._queue_for(message), MessageBody=json.dumps(body))
+                sent += 1
+            except Exception as e:
+                print(f"Failed to dispatch job for video {message['video_id']}: {e}")
+                set_pending_job(message["user_id"], message["video_id"], message["output_format"], json.dumps(message))
+                with self.lock:
+                    self._enqueue(message, front=True)
+        return sent
+
+    def recover(self):
+        """Load held jobs this replica doesn't know about: its own after a restart, or a lost replica's.
+
+        A job another live replica also holds is harmless, whichever claims it
+        first sends it and the other skips it.
+        """
+        jobs = sorted((json.loads(job) for job in held_jobs()), key=lambda m: m["submitted_at"])
+        recovered = 0
+        with self.lock:
+            queued = {(m["video_id"], m["output_format"]) for user_jobs in self.pending.values() for m in user_jobs}
+            for message in jobs:
+                if (message["video_id"], message["output_format"]) not in queued:
+                    self._enqueue(message)
+                    recovered += 1
+        return recovered
+
+    async def run(self):
+        next_reconcile = 0
+        while True:
+            if time.monotonic() >= next_reconcile:
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+                try:
+                    recovered = await run_blocking(self.recover)
+                    if recovered:
+                        print(f"Dispatcher recovered {recovered} pending job(s)")
+                except Exception as e:
+                    print(f"Dispatcher could not recover pending jobs: {e}")
+
+            try:
+                await run_blocking(self.release)
+            except Exception as e:
+                print(f"Dispatcher release failed: {e}")
+            await asyncio.sleep(DISPATCH_INTERVAL)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
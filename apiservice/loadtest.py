@@ -0,0 +1,92 @@
+"""Concurrent load against one API route, to check throughput scales with clients.
+
+Each level runs CONCURRENCY clients in a closed loop for DURATION seconds and
+reports requests/s and latency percentiles. With AWS calls on the event loop
+req/s stays flat as clients are added; off the loop it should climb until
+AWS_MAX_CONCURRENCY (or DynamoDB) is the limit.
+
+    python loadtest.py --base-url http://localhost:3000 --token $JWT --path /videos/list --concurrency 1 4 16 32
+"""
+import argparse
+import threading
+import time
+
+import requests
+
+
+def run_level(url, headers, concurrency, duration):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        nonlocal errors
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                ok = session.get(url, headers=headers, timeout=30).ok
+            except requests.RequestException:
+                ok = False
+            elapsed = time.monotonic() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.monotonic() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0
+
+    return {
+        "concurrency": concurrency,
+        "rps": len(latencies) / wall,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API throughput at increasing client concurrency")
+    parser.add_argument("--base-url", default="http://localhost:3000")
+    parser.add_argument("--token", required=True, help="JWT sent as the Bearer token")
+    parser.add_argument("--path", default="/videos/list")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--duration", type=float, default=15)
+    args = parser.parse_args()
+
+    url = args.base_url.rstrip("/") + args.path
+    headers = {"Authorization": f"Bearer {args.token}"}
+
+    results = []
+    for concurrency in args.concurrency:
+        result = run_level(url, headers, concurrency, args.duration)
+        print(
+            f"[INFO] {concurrency} client(s): {result['rps']:.1f} req/s, "
+            f"p50 {result['p50_ms']:.0f}ms, p95 {result['p95_ms']:.0f}ms, {result['errors']} error(s)"
+        )
+        results.append(result)
+
+    base = results[0]["rps"] or 1
+    print()
+    print("clients   req/s  speedup  p50 ms  p95 ms  errors")
+    for r in results:
+        print(
+            f"{r['concurrency']:>7}  {r['rps']:>6.1f}  {r['rps'] / base:>6.2f}x  "
+            f"{r['p50_ms']:>6.0f}  {r['p95_ms']:>6.0f}  {r['errors']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@ import boto3
 import uuid
 import os
 from datetime import datetime, timezone
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 from pstore import load_parameters
+from aws import AWS_CONFIG
 
 
 parameters = load_parameters()
@@ -13,9 +16,24 @@ TABLE_NAME = parameters.get("s3bucket")
 
 
 
-dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION)
+dynamodb = boto3.resource("dynamodb", region_name=AWS_REGION, config=AWS_CONFIG)
 table = dynamodb.Table(TABLE_NAME)
 
+# created_at-sorted GSIs used for listing, by the attribute they are partitioned
+# on. Every item carries catalog=CATALOG so admins can list the whole table in
+# order from one partition.
+CATALOG = "videos"
+LIST_INDEXES = {
+    "user_id": "user_id-created_at-index",
+    "catalog": "catalog-created_at-index",
+    "status": "status-created_at-index",
+    "owner": "owner-created_at-index",
+}
+# video_id -> table key, for admins who don't know the owning user_id
+VIDEO_ID_INDEX = "video_id-index"
+# Sparse: only videos with jobs held by the fair-share dispatcher carry pending
+PENDING_INDEX = "pending-created_at-index"
+
 
 def create_video(filename, filepath, title=None, description=None, owner=None, user_id=None, status="uploaded", format=None):
     video_id = str(uuid.uuid4())
@@ -25,13 +43,16 @@ def create_video(filename, filepath, title=None, description=None, owner=None, u
         "user_id": user_id or "anonymous",
         "video_id": video_id,
         "filename": filename,
+        "filename_lower": filename.lower(),
         "filepath": filepath,
         "title": title or "",
         "description": description or "",
         "status": status,
         "format": format or "",
-        "owner": owner or "",
+        # index keys can't be empty strings
+        "owner": owner or "anonymous",
         "created_at": created_at,
+        "catalog": CATALOG,
     }
 
     try:
@@ -41,37 +62,95 @@ def create_video(filename, filepath, title=None, description=None, owner=None, u
         raise Exception(f"Error creating video: {e}")
 
     
+def video_key(user_role, user_id, video_id):
+    """Table key of a video: the caller's own for users, looked up by video_id for admins."""
+    if user_role != "admin":
+        return {"user_id": user_id, "video_id": video_id}
+    resp = table.query(
+        IndexName=VIDEO_ID_INDEX,
+        KeyConditionExpression=Key("video_id").eq(video_id),
+        Limit=1
+    )
+    items = resp.get("Items", [])
+    return {"user_id": items[0]["user_id"], "video_id": video_id} if items else None
+
+
 def get_video_by_id(user_role, user_id, video_id):
     try:
-        if user_role == "admin":
-            resp = table.scan(
-                FilterExpression="video_id = :vid",
-                ExpressionAttributeValues={":vid": video_id}
-            )
-            items = resp.get("Items", [])
-            return items[0] if items else None
-        else:
-            resp = table.get_item(Key={"user_id": user_id, "video_id": video_id})
-            return resp.get("Item")
+        key = video_key(user_role, user_id, video_id)
+        if key is None:
+            return None
+        resp = table.get_item(Key=key)
+        return resp.get("Item")
     except ClientError as e:
         raise Exception(f"Error retrieving video: {e}")
 
 
-def list_videos(user_id):
+def query_all(**kwargs):
+    # follow LastEvaluatedKey past DynamoDB's 1 MB page
+    items = []
+    while True:
+        resp = table.query(**kwargs)
+        items.extend(resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            return items
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+
+def filter_expression(status=None, owner=None, search=None):
+    conditions = []
+    if status:
+        conditions.append(Attr("status").eq(status))
+    if owner:
+        conditions.append(Attr("owner").eq(owner))
+    if search:
+        # filename_lower is missing on items created before it existed
+        conditions.append(Attr("filename_lower").contains(search.lower()) | Attr("filename").contains(search))
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+def list_video_page(partition, value, limit, descending=True, start_key=None, status=None, owner=None, search=None):
+    """One created_at-ordered page from a listing index, and the key to continue from (None at the end).
+
+    Reads stop as soon as the page is full, so the cost follows the page size
+    rather than the size of the partition.
+    """
+    kwargs = {
+        "IndexName": LIST_INDEXES[partition],
+        "KeyConditionExpression": Key(partition).eq(value),
+        "ScanIndexForward": not descending,
+        "Limit": limit,
+    }
+    expression = filter_expression(status, owner, search)
+    if expression is not None:
+        kwargs["FilterExpression"] = expression
+        # Limit counts items read before filtering
+        kwargs["Limit"] = max(limit, 100)
+
+    items = []
     try:
-        resp = table.query(
-            KeyConditionExpression=boto3.dynamodb.conditions.Key("user_id").eq(user_id)
-        )
-        return resp.get("Items", [])
+        while True:
+            if start_key:
+                kwargs["ExclusiveStartKey"] = start_key
+            resp = table.query(**kwargs)
+            page = resp.get("Items", [])
+            start_key = resp.get("LastEvaluatedKey")
+            for i, item in enumerate(page):
+                items.append(item)
+                if len(items) == limit:
+                    if i == len(page) - 1 and not start_key:
+                        return items, None
+                    # continue right after this item, even mid-way through DynamoDB's page
+                    return items, {k: item[k] for k in ("user_id", "video_id", "created_at", partition)}
+            if not start_key:
+                return items, None
     except ClientError as e:
         raise Exception(f"Error listing videos: {e}")
-    
-def all_videos():
-    try:
-        resp = table.scan()
-        return resp.get("Items", [])
-    except ClientError as e:
-        raise Exception(f"Error listing all videos: {e}")
 
 
 def update_status(user_id, video_id, status):
@@ -88,12 +167,28 @@ def update_status(user_id, video_id, status):
         raise Exception(f"Error updating video status: {e}")
     
 
-def update_status_progress(user_id, video_id, status, progress=None, format=None):
+def to_dynamo(value):
+    # DynamoDB rejects floats, so store them as Decimal
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamo(v) for v in value]
+    return value
+
+
+def update_status_progress(user_id, video_id, status, progress=None, format=None, extra=None):
 
     update_expr = ["#s = :s"]
     expr_attr_vals = {":s": status}
     expr_attr_names = {"#s": "status"}
 
+    for i, (name, value) in enumerate((extra or {}).items()):
+        update_expr.append(f"#x{i} = :x{i}")
+        expr_attr_vals[f":x{i}"] = to_dynamo(value)
+        expr_attr_names[f"#x{i}"] = name
+
     if progress is not None:
         update_expr.append("#p = :p")
         expr_attr_vals[":p"] = progress
@@ -118,6 +213,75 @@ def update_status_progress(user_id, video_id, status, progress=None, format=None
 
 
 
+def set_pending_job(user_id, video_id, output_format, job):
+    """Hold job on the video until the dispatcher releases it; False if that format is already held."""
+    key = {"user_id": user_id, "video_id": video_id}
+    try:
+        table.update_item(
+            Key=key,
+            UpdateExpression="SET pending_jobs = if_not_exists(pending_jobs, :empty)",
+            ExpressionAttributeValues={":empty": {}},
+        )
+        # pending is only set while jobs are held, so PENDING_INDEX lists just those videos
+        table.update_item(
+            Key=key,
+            UpdateExpression="SET #s = :s, #p = :p, pending_jobs.#f = :j",
+            ConditionExpression="attribute_not_exists(pending_jobs.#f)",
+            ExpressionAttributeNames={"#s": "status", "#p": "pending", "#f": output_format},
+            ExpressionAttributeValues={":s": "queued", ":p": CATALOG, ":j": job},
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise Exception(f"Error queueing video job: {e}")
+
+
+def claim_pending_job(user_id, video_id, output_format):
+    # Only one caller gets True for a given job, so it is sent to SQS once
+    key = {"user_id": user_id, "video_id": video_id}
+    try:
+        resp = table.update_item(
+            Key=key,
+            UpdateExpression="SET #s = :s REMOVE pending_jobs.#f",
+            ConditionExpression="attribute_exists(pending_jobs.#f)",
+            ExpressionAttributeNames={"#s": "status", "#f": output_format},
+            ExpressionAttributeValues={":s": "transcoding"},
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return False
+        raise Exception(f"Error releasing video job: {e}")
+
+    if not resp["Attributes"].get("pending_jobs"):
+        try:
+            table.update_item(
+                Key=key,
+                UpdateExpression="REMOVE #p",
+                ConditionExpression="size(pending_jobs) = :zero",
+                ExpressionAttributeNames={"#p": "pending"},
+                ExpressionAttributeValues={":zero": 0},
+            )
+        except ClientError as e:
+            # another format was held in the meantime and keeps the video listed
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise Exception(f"Error releasing video job: {e}")
+    return True
+
+
+def held_jobs():
+    """Every job still held on a video item, as the JSON strings set_pending_job stored."""
+    try:
+        items = query_all(
+            IndexName=PENDING_INDEX,
+            KeyConditionExpression=Key("pending").eq(CATALOG),
+        )
+    except ClientError as e:
+        raise Exception(f"Error listing pending video jobs: {e}")
+    return [job for item in items for job in item.get("pending_jobs", {}).values()]
+
+
 def update_video_metadata(user_role, user_id, video_id, format=None, filename=None, title=None, description=None):
     update_expr = []
     expr_attr_vals = {}
@@ -132,6 +296,9 @@ def update_video_metadata(user_role, user_id, video_id, format=None, filename=No
         update_expr.append("#fn = :fn")
         expr_attr_vals[":fn"] = filename
         expr_attr_names["#fn"] = "filename"
+        update_expr.append("#fl = :fl")
+        expr_attr_vals[":fl"] = filename.lower()
+        expr_attr_names["#fl"] = "filename_lower"
 
     if title:
         update_expr.append("#t = :t")
@@ -147,8 +314,11 @@ def update_video_metadata(user_role, user_id, video_id, format=None, filename=No
         return get_video_by_id(user_role, user_id, video_id)
 
     try:
+        key = video_key(user_role, user_id, video_id)
+        if key is None:
+            return None
         resp = table.update_item(
-            Key={"user_id": user_id, "video_id": video_id},
+            Key=key,
             UpdateExpression="SET " + ", ".join(update_expr),
             ExpressionAttributeNames=expr_attr_names,
             ExpressionAttributeValues=expr_attr_vals,
@@ -161,20 +331,11 @@ def update_video_metadata(user_role, user_id, video_id, format=None, filename=No
 
 def remove_video(user_role, user_id, video_id):
     try:
-        if user_role == "admin":
-            response = table.scan(
-                FilterExpression="video_id = :vid",
-                ExpressionAttributeValues={":vid": video_id}
-            )
-            items = response.get("Items", [])
-            if not items:
-                return False  #  not found
-            for item in items:
-                table.delete_item(Key={"user_id": item["user_id"], "video_id": video_id})
-            return True
-        else:
-            table.delete_item(Key={"user_id": user_id, "video_id": video_id})
-            return True
+        key = video_key(user_role, user_id, video_id)
+        if key is None:
+            return False  #  not found
+        table.delete_item(Key=key)
+        return True
     except ClientError as e:
         raise Exception(f"Error deleting video: {e}")
 
@@ -0,0 +1,112 @@
+# Named encoding profiles. The API validates jobs against this registry and the
+# worker turns the chosen profile into ffmpeg arguments, so keep
+# apiservice/profiles.py and videoworker/profiles.py identical.
+
+PROFILES = {
+    # Balanced H.264/AAC, the behaviour jobs had before profiles existed.
+    # Sources already in these codecs are remuxed instead of re-encoded.
+    "default": {
+        "containers": ["mp4", "mov", "mkv", "hls", "dash"],
+        "video_codec": "libx264",
+        "preset": "medium",
+        "crf": 23,
+        "audio_codec": "aac",
+        "audio_bitrate": "128k",
+        "remux": True,
+    },
+    # Fast, small previews: capped at 480p, fewest encoder passes, two threads
+    # per job so more jobs fit on a task.
+    "preview/fast": {
+        "containers": ["mp4", "mkv", "hls", "dash"],
+        "video_codec": "libx264",
+        "preset": "veryfast",
+        "crf": 28,
+        "max_height": 480,
+        "threads": 2,
+        "audio_codec": "aac",
+        "audio_bitrate": "96k",
+    },
+    # Smallest files for long-term storage, at the cost of encode time.
+    "archive/small": {
+        "containers": ["mp4", "mkv", "mov"],
+        "video_codec": "libx265",
+        "preset": "slow",
+        "crf": 28,
+        "audio_codec": "aac",
+        "audio_bitrate": "96k",
+    },
+    "web/vp9": {
+        "containers": ["webm", "mkv", "dash"],
+        "video_codec": "libvpx-vp9",
+        "crf": 33,
+        "extra_video_args": ["-b:v", "0", "-row-mt", "1", "-deadline", "good", "-cpu-used", "4"],
+        "audio_codec": "libopus",
+        "audio_bitrate": "96k",
+    },
+    # Drops the video stream entirely, so it is never decoded.
+    "audio/aac": {
+        "containers": ["m4a", "mp4", "mkv"],
+        "audio_only": True,
+        "audio_codec": "aac",
+        "audio_bitrate": "128k",
+    },
+}
+
+DEFAULT_PROFILE = "default"
+
+# Profile used when a job only names an output format
+FORMAT_PROFILES = {
+    "webm": "web/vp9",
+    "m4a": "audio/aac",
+}
+
+
+def resolve_profile(profile_name=None, output_format=None):
+    """Return (name, profile, container) for a job, raising ValueError if the combination is invalid."""
+    if not profile_name:
+        profile_name = FORMAT_PROFILES.get(output_format, DEFAULT_PROFILE)
+
+    profile = PROFILES.get(profile_name)
+    if profile is None:
+        raise ValueError(f"Unknown profile '{profile_name}'")
+
+    container = output_format or profile["containers"][0]
+    if container not in profile["containers"]:
+        raise ValueError(
+            f"Profile '{profile_name}' cannot produce '{container}', use one of {', '.join(profile['containers'])}"
+        )
+    return profile_name, profile, container
+
+
+def ffmpeg_args(profile):
+    """Output-side codec arguments for a profile."""
+    args = []
+    if profile.get("audio_only"):
+        args += ["-vn"]
+    else:
+        args += ["-c:v", profile["video_codec"]]
+        if "preset" in profile:
+            args += ["-preset", profile["preset"]]
+        if "crf" in profile:
+            args += ["-crf", str(profile["crf"])]
+        if "max_height" in profile:
+            args += ["-vf", f"scale=-2:'min({profile['max_height']},ih)'"]
+        args += profile.get("extra_video_args", [])
+
+    args += audio_args(profile)
+    if "threads" in profile:
+        args += ["-threads", str(profile["threads"])]
+    return args
+
+
+def audio_args(profile):
+    """Output-side audio codec arguments for a profile."""
+    args = ["-c:a", profile["audio_codec"]]
+    if "audio_bitrate" in profile:
+        args += ["-b:a", profile["audio_bitrate"]]
+    return args
+
+
+def cache_params(profile_name, container):
+    """Everything that changes the encoded bytes, used to address cached outputs."""
+    return {"profile": profile_name, "container": container, "settings": PROFILES[profile_name]}
@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from aws import run_blocking
+
+
+# A status update can land on another API replica, so each video with viewers
+# here is also polled, once per process, unless an update arrived recently.
+PROGRESS_POLL_INTERVAL = float(os.environ.get("PROGRESS_POLL_INTERVAL", 5))
+PROGRESS_HEARTBEAT = float(os.environ.get("PROGRESS_HEARTBEAT", 15))
+PROGRESS_QUEUE_SIZE = int(os.environ.get("PROGRESS_QUEUE_SIZE", 16))
+
+
+class ProgressHub:
+    """In-process pub/sub of video status/progress for SSE clients.
+
+    Events are only sent when status or progress changes. Each subscriber has
+    a bounded queue; a slow client loses its oldest events rather than growing
+    memory, which is fine because every event carries the full current state.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.last_state = {}
+        self.last_publish = {}
+        self.pollers = {}
+
+    def publish(self, video_id, item):
+        if not item or video_id not in self.subscribers:
+            return
+        event = jsonable_encoder(item)
+        state = (event.get("status"), event.get("progress"))
+        self.last_publish[video_id] = time.monotonic()
+        if self.last_state.get(video_id) == state:
+            return
+        self.last_state[video_id] = state
+
+        for queue in self.subscribers.get(video_id, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _poll(self, video_id, fetch):
+        while True:
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+            if time.monotonic() - self.last_publish.get(video_id, 0) < PROGRESS_POLL_INTERVAL:
+                continue
+            try:
+                self.publish(video_id, await run_blocking(fetch))
+            except Exception as e:
+                print(f"Progress poll failed for video {video_id}: {e}")
+
+    def _subscribe(self, video_id, fetch):
+        queue = asyncio.Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        self.subscribers.setdefault(video_id, set()).add(queue)
+        if video_id not in self.pollers:
+            self.pollers[video_id] = asyncio.get_running_loop().create_task(self._poll(video_id, fetch))
+        return queue
+
+    def _unsubscribe(self, video_id, queue):
+        queue_set = self.subscribers.get(video_id, set())
+        queue_set.discard(queue)
+        if not queue_set:
+            self.subscribers.pop(video_id, None)
+            self.last_state.pop(video_id, None)
+            self.last_publish.pop(video_id, None)
+            poller = self.pollers.pop(video_id, None)
+            if poller:
+                poller.cancel()
+
+    async def stream(self, video_id, current, fetch):
+        """SSE lines for one client: the current item, then changes and heartbeats until it disconnects."""
+        queue = self._subscribe(video_id, fetch)
+        try:
+            event = jsonable_encoder(current)
+            self.last_state.setdefault(video_id, (event.get("status"), event.get("progress")))
+            yield f"data: {json.dumps(event)}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PROGRESS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            self._unsubscribe(video_id, queue)
+
+
+hub = ProgressHub()
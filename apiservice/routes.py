@@ -1,22 +1,48 @@
-import asyncio
 from fastapi import APIRouter, Request, BackgroundTasks, Depends, HTTPException, Body
 from fastapi.responses import StreamingResponse
 from auth import get_current_user
 from models import get_video_by_id, update_video_metadata
 import os
-import json
 import boto3
 from controllers import (
-    get_all_videos,
+    get_video_page,
     upload_video,
     transcode_video,
     delete_video,
+    get_playlist,
+    get_sprite_index,
+    queue_depths,
     update_status_progress
 )
 from pstore import load_parameters
+from progress_hub import hub as progress_hub
+from aws import AWS_CONFIG, run_blocking
 
 router = APIRouter()
 
+# Extra attributes a worker may record on the video item with a status update
+STATUS_FIELDS = (
+    "speed", "error", "outputs", "playlist_key", "output_key", "transcode_path", "poster_key", "sprites_key"
+)
+# The status route is unauthenticated and these keys are later presigned, so
+# they must point at worker outputs, never at an upload or another prefix
+OUTPUT_PREFIX = "transcoded/"
+
+
+def _under(key, prefix):
+    return isinstance(key, str) and key.startswith(prefix) and ".." not in key.split("/")
+
+
+def check_output_keys(video_id, fields):
+    keys = [fields.get("output_key"), fields.get("playlist_key")]
+    keys += [output.get("key") if isinstance(output, dict) else output for output in fields.get("outputs") or []]
+    for key in keys:
+        if key is not None and not _under(key, OUTPUT_PREFIX):
+            raise HTTPException(status_code=400, detail=f"Output keys must be under {OUTPUT_PREFIX}")
+    for field in ("poster_key", "sprites_key"):
+        if fields.get(field) is not None and not _under(fields[field], f"thumbnails/{video_id}/"):
+            raise HTTPException(status_code=400, detail=f"{field} must be under thumbnails/{video_id}/")
+
 
 parameters = load_parameters()
 
@@ -24,54 +50,34 @@ AWS_REGION = parameters.get("awsregion", "ap-southeast-2")
 S3_BUCKET = parameters.get("s3bucket")
 
 
-s3_client = boto3.client("s3", region_name=AWS_REGION)
+s3_client = boto3.client("s3", region_name=AWS_REGION, config=AWS_CONFIG)
 
 
 @router.get("/list")
 async def list_videos(
     current_user: dict = Depends(get_current_user),
-    skip: int = 0,
     limit: int = 10,
+    cursor: str | None = None,
     sort_by: str = "created_at",
     order: str = "desc",
     status: str | None = None,
     owner: str | None = None,
     search: str | None = None,
 ):
-    videos = get_all_videos(user_id=None if current_user["role"]=="admin" else current_user["id"]) 
+    return await run_blocking(get_video_page, current_user, limit, cursor, sort_by, order, status, owner, search)
 
-    if current_user["role"] != "admin":
-        videos = [v for v in videos if v["owner"] == current_user["username"]]
 
-    if status:
-        videos = [v for v in videos if v["status"] == status]
-    if owner:
-        videos = [v for v in videos if v["owner"] == owner]
-    if search:
-        videos = [v for v in videos if search.lower() in v["filename"].lower()]
-
-    # if videos and sort_by in videos[0]:
-    #     videos.sort(key=lambda v: v.get(sort_by), reverse=(order == "desc"))
-
-    if videos:
-        videos.sort(
-            key=lambda v: v.get(sort_by) or "",  # fallback so None won't break sorting
-            reverse=(order == "desc")
-        )
-
-    return {
-        "total": len(videos),
-        "skip": skip,
-        "limit": limit,
-        "items": videos[skip : skip + limit],
-    }
 
+@router.get("/queue")
+async def queue(current_user: dict = Depends(get_current_user)):
+    # Jobs waiting for a fair-share slot, per user (admins see every user)
+    return queue_depths(current_user)
 
 
 @router.get("/{video_id}")
 async def get_video_route(video_id: str, current_user: dict = Depends(get_current_user)):
  
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    video = await run_blocking(get_video_by_id, current_user['role'], current_user['id'], video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     if video["owner"] != current_user["username"] and current_user["role"] != "admin":
@@ -90,11 +96,7 @@ async def upload_video_route(
 
 @router.post("/{video_id}/transcode")
 async def transcode_endpoint(video_id: str,request: Request,background_tasks: BackgroundTasks,current_user: dict = Depends(get_current_user)):
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
-    if not video:
-        raise HTTPException(status_code=404, detail="Video not found")
-    if video["owner"] != current_user["username"] and current_user["role"] != "admin":
-        raise HTTPException(status_code=403, detail="Not authorized to transcode this video")
+    # transcode_video does the lookup and ownership check
     return await transcode_video(video_id, request, background_tasks, current_user)
 
 
@@ -105,18 +107,23 @@ async def delete_video_route(video_id: str, current_user: dict = Depends(get_cur
 
 @router.get("/{video_id}/download")
 async def download_video(video_id: str, current_user: dict = Depends(get_current_user)):
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    video = await run_blocking(get_video_by_id, current_user['role'], current_user['id'], video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
     
     if video["owner"] != current_user["username"] and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to download this video")
+
+    # Segmented outputs are played from a playlist rather than downloaded
+    if video.get("playlist_key"):
+        return {"playlist_url": f"/videos/{video_id}/playlist", "format": video.get("format")}
     
     #S3 presigned URL
     try:
-        presigned_url = s3_client.generate_presigned_url(
+        presigned_url = await run_blocking(
+            s3_client.generate_presigned_url,
             "get_object",
-            Params={"Bucket": S3_BUCKET, "Key": video["filepath"]}, 
+            Params={"Bucket": S3_BUCKET, "Key": video.get("output_key") or video["filepath"]},
             ExpiresIn=3600
         )
         return {"download_url": presigned_url}
@@ -125,16 +132,26 @@ async def download_video(video_id: str, current_user: dict = Depends(get_current
 
 
 
+@router.get("/{video_id}/playlist")
+async def playlist_route(video_id: str, current_user: dict = Depends(get_current_user)):
+    return await run_blocking(get_playlist, video_id, current_user)
+
+
+@router.get("/{video_id}/sprites.vtt")
+async def sprites(video_id: str, current_user: dict = Depends(get_current_user)):
+    return await run_blocking(get_sprite_index, video_id, current_user)
+
+
 @router.put("/{video_id}")
 async def update_video_route(video_id: str, metadata: dict = Body(...), current_user: dict = Depends(get_current_user)):
-    video = get_video_by_id(current_user['role'], current_user['id'], video_id)
+    video = await run_blocking(get_video_by_id, current_user['role'], current_user['id'], video_id)
     if not video:
         raise HTTPException(status_code=404, detail="Video not found")
 
     if video["owner"] != current_user["username"] and current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Not authorized to update this video")
 
-    updated_video = update_video_metadata(current_user['role'],current_user["id"],video_id, metadata)
+    updated_video = await run_blocking(update_video_metadata, current_user['role'],current_user["id"],video_id, metadata)
     if not updated_video:
         raise HTTPException(status_code=400, detail="No valid fields to update")
 
@@ -143,24 +160,25 @@ async def update_video_route(video_id: str, metadata: dict = Body(...), current_
 
 @router.get("/{video_id}/progress/stream")
 async def stream_progress(video_id: str, current_user: dict = Depends(get_current_user)):
-    async def event_generator():
-        try:
-            while True:
-                video = get_video_by_id(current_user['role'], current_user['id'], video_id)
-                if video:
-                    yield f"data: {json.dumps(video)}\n\n"
-                await asyncio.sleep(2)  #Stream updates 2s
-        except asyncio.CancelledError:
-           
-            print(f"Client disconnected from video {video_id} progress stream")
-            return
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    def fetch():
+        return get_video_by_id(current_user['role'], current_user['id'], video_id)
+
+    video = await run_blocking(fetch)
+    if not video:
+        raise HTTPException(status_code=404, detail="Video not found")
+
+    # Pushed by the status route below, with at most one DynamoDB poll per video
+    return StreamingResponse(progress_hub.stream(video_id, video, fetch), media_type="text/event-stream")
 
 @router.post("/{video_id}/status")
 async def update_video_status(video_id: str, data: dict):
     status = data.get("status")
     progress = data.get("progress", 0)
     fmt = data.get("format")
-    update_status_progress(None, video_id, status=status, progress=progress, format=fmt)
+    extra = {field: data[field] for field in STATUS_FIELDS if field in data}
+    check_output_keys(video_id, extra)
+    item = await run_blocking(
+        update_status_progress, data.get("user_id"), video_id, status=status, progress=progress, format=fmt, extra=extra
+    )
+    progress_hub.publish(video_id, item)
     return {"message": "Status updated"}
\ No newline at end of file
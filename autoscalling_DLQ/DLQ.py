@@ -9,6 +9,12 @@ import os
 MAIN_QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n11715910-a2"
 REGION = "ap-southeast-2"
 REQUIRED_FIELDS = ["video_id", "output_format", "filename", "input_key"]
+# Valid messages go back to the priority lane they were routed to
+LANE_QUEUES = {
+    "small": os.environ.get("QUEUE_URL_SMALL", MAIN_QUEUE_URL),
+    "medium": os.environ.get("QUEUE_URL_MEDIUM", MAIN_QUEUE_URL),
+    "large": os.environ.get("QUEUE_URL_LARGE", MAIN_QUEUE_URL),
+}
 
 # -----------------------------
 # Logging
@@ -31,7 +37,7 @@ def lambda_handler(event, context):
 
             if all(field in body for field in REQUIRED_FIELDS):
                 sqs.send_message(
-                    QueueUrl=MAIN_QUEUE_URL,
+                    QueueUrl=LANE_QUEUES.get(body.get("lane"), MAIN_QUEUE_URL),
                     MessageBody=json.dumps(body)
                 )
                 logger.info(f"Requeued valid message: {body['video_id']}")
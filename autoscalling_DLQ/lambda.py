@@ -11,27 +11,62 @@ QUEUE_URL = os.environ.get(
     "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n11715910-a2"
 )
 
+# Every priority lane queue the workers drain (comma separated)
+QUEUE_URLS = [
+    url for url in os.environ.get("QUEUE_URLS", QUEUE_URL).split(",") if url
+]
+
+# Jobs the API's fair-share dispatcher holds back from SQS are counted too,
+# otherwise the fleet would stop scaling once the lanes are topped up
+TABLE_NAME = os.environ.get("TABLE_NAME", "n11715910-a")
+PENDING_INDEX = os.environ.get("PENDING_INDEX", "pending-created_at-index")
+
 SCALE_FACTOR = 1
 FIXED_INSTANCES = int(os.environ.get("FIXED_INSTANCES", 1))
 
 sqs = boto3.client("sqs", region_name=REGION)
 cloudwatch = boto3.client("cloudwatch", region_name=REGION)
+dynamodb = boto3.client("dynamodb", region_name=REGION)
+
+
+def held_jobs():
+    total = 0
+    kwargs = {
+        "TableName": TABLE_NAME,
+        "IndexName": PENDING_INDEX,
+        "KeyConditionExpression": "#p = :p",
+        "ProjectionExpression": "pending_jobs",
+        "ExpressionAttributeNames": {"#p": "pending"},
+        "ExpressionAttributeValues": {":p": {"S": "videos"}},
+    }
+    while True:
+        resp = dynamodb.query(**kwargs)
+        total += sum(len(item.get("pending_jobs", {}).get("M", {})) for item in resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            return total
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
 
 def lambda_handler(event, context):
     try:
-        # Get both visible and in-flight messages
-        attrs = sqs.get_queue_attributes(
-            QueueUrl=QUEUE_URL,
-            AttributeNames=[
-                'ApproximateNumberOfMessages',
-                'ApproximateNumberOfMessagesNotVisible'
-            ]
-        )
-        visible_messages = int(attrs['Attributes'].get('ApproximateNumberOfMessages', 0))
-        invisible_messages = int(attrs['Attributes'].get('ApproximateNumberOfMessagesNotVisible', 0))
-        total_messages = visible_messages + invisible_messages
+        # Get both visible and in-flight messages across all lanes
+        total_messages = 0
+        for queue_url in QUEUE_URLS:
+            attrs = sqs.get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=[
+                    'ApproximateNumberOfMessages',
+                    'ApproximateNumberOfMessagesNotVisible'
+                ]
+            )
+            visible_messages = int(attrs['Attributes'].get('ApproximateNumberOfMessages', 0))
+            invisible_messages = int(attrs['Attributes'].get('ApproximateNumberOfMessagesNotVisible', 0))
+            total_messages += visible_messages + invisible_messages
         logger.info(f"Total messages in queue (visible + in-flight): {total_messages}")
 
+        held = held_jobs()
+        logger.info(f"Jobs held by the dispatcher: {held}")
+        total_messages += held
+
         in_service_instances = max(FIXED_INSTANCES, 1) 
         logger.info(f"Using fixed instance count: {in_service_instances}")
 
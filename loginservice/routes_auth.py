@@ -3,7 +3,6 @@ from fastapi import APIRouter, HTTPException, Body
 from cognito import (
     sign_up_user, confirm_user, authenticate_user, respond_to_mfa_challenge
 )
-import requests
 import os
 import jwt
 from jose import jwk, jwt as jose_jwt, JWTError
@@ -20,11 +19,6 @@ COGNITO_REGION = parameters.get("awsregion", "ap-southeast-2")
 COGNITO_USERPOOL_ID = parameters.get("cognitouserpoolid")
 
 
-
-JWKS_URL = f"https://cognito-idp.{COGNITO_REGION}.amazonaws.com/{COGNITO_USERPOOL_ID}/.well-known/jwks.json"
-jwks = requests.get(JWKS_URL).json()
-
-
 @router.post("/signup")
 async def signup(username: str = Body(...), password: str = Body(...), email: str = Body(...)):
     try:
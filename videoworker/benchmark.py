@@ -0,0 +1,469 @@
+"""Offline throughput benchmark for the video worker.
+
+Runs worker.poll_queue against in-process stand-ins for SQS, S3 and the status
+API, over synthetic sources generated with ffmpeg's lavfi test sources, and
+reports jobs/minute, per-stage latency, realtime encode factor and peak
+RSS/scratch disk. Nothing touches AWS.
+
+    python benchmark.py --concurrency 4 --repeat 1
+    python benchmark.py --concurrency 4 --pipeline
+    python benchmark.py --source big:1920x1080:120:libx264:mp4 --profile preview/fast
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+import worker
+from source_cache import SourceCache
+
+# name:WIDTHxHEIGHT:seconds:video_codec:container
+DEFAULT_SOURCES = [
+    "clip-360p-h264:640x360:10:libx264:mp4",
+    "clip-720p-h264:1280x720:30:libx264:mov",
+    "clip-1080p-hevc:1920x1080:20:libx265:mkv",
+    "clip-720p-vp9:1280x720:15:libvpx-vp9:webm",
+]
+
+GENERATOR_ARGS = {
+    "libx264": ["-preset", "veryfast", "-pix_fmt", "yuv420p"],
+    "libx265": ["-preset", "veryfast", "-pix_fmt", "yuv420p"],
+    "libvpx-vp9": ["-deadline", "realtime", "-cpu-used", "8", "-pix_fmt", "yuv420p"],
+}
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class LocalBody:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        while True:
+            data = self.stream.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+class LocalPaginator:
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        yield self.method(**kwargs)
+
+
+class LocalS3:
+    """Directory-backed stand-in for the subset of the S3 client the worker uses."""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.uploads = {}
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _etag(self, path):
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return f'"{digest.hexdigest()}"'
+
+    def _write(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def head_object(self, Bucket, Key, **kwargs):
+        path = self._path(Key)
+        if not os.path.exists(path):
+            raise client_error("404", "HeadObject")
+        return {"ContentLength": os.path.getsize(path), "ETag": self._etag(path)}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        path = self._path(Key)
+        if not os.path.exists(path):
+            raise client_error("NoSuchKey", "GetObject")
+        with open(path, "rb") as f:
+            if Range:
+                start, end = Range.replace("bytes=", "").split("-")
+                f.seek(int(start))
+                data = f.read(int(end) - int(start) + 1)
+            else:
+                data = f.read()
+        return {"Body": LocalBody(data), "ContentLength": len(data)}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        path = self._path(Key)
+        if not os.path.exists(path):
+            raise client_error("404", "HeadObject")
+        shutil.copyfile(path, Filename)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+        os.makedirs(os.path.dirname(self._path(Key)), exist_ok=True)
+        shutil.copyfile(Filename, self._path(Key))
+
+    def put_object(self, Bucket, Key, Body=b"", IfNoneMatch=None, **kwargs):
+        with self.lock:
+            if IfNoneMatch == "*" and os.path.exists(self._path(Key)):
+                raise client_error("PreconditionFailed", "PutObject")
+            self._write(Key, Body if isinstance(Body, bytes) else Body.read())
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        contents = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                key = os.path.relpath(os.path.join(dirpath, name), self.root)
+                if key.startswith(Prefix):
+                    contents.append({"Key": key, "Size": os.path.getsize(os.path.join(dirpath, name))})
+        contents.sort(key=lambda obj: obj["Key"])
+        return {"KeyCount": len(contents), "Contents": contents}
+
+    def get_paginator(self, operation):
+        return LocalPaginator(getattr(self, operation))
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for obj in Delete["Objects"]:
+            if os.path.exists(self._path(obj["Key"])):
+                os.remove(self._path(obj["Key"]))
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = data
+        return {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+        self._write(Key, b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"]))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn=3600, **kwargs):
+        # ffmpeg/ffprobe read local paths just like presigned URLs
+        return self._path(Params["Key"])
+
+
+class LocalSQS:
+    """In-memory stand-in for the SQS calls the worker makes, with visibility timeouts."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = defaultdict(dict)
+        self.receive_seconds = []
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message_id = uuid.uuid4().hex
+        with self.lock:
+            self.queues[QueueUrl][message_id] = {"Body": MessageBody, "visible_at": 0.0, "receipt": None}
+        return {"MessageId": message_id}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        for entry in Entries:
+            self.send_message(QueueUrl, entry["MessageBody"])
+        return {"Successful": [{"Id": e["Id"]} for e in Entries], "Failed": []}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, **kwargs):
+        started = time.monotonic()
+        now = time.monotonic()
+        messages = []
+        with self.lock:
+            for message_id, msg in self.queues[QueueUrl].items():
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+                if msg["visible_at"] > now:
+                    continue
+                msg["receipt"] = uuid.uuid4().hex
+                msg["visible_at"] = now + VisibilityTimeout
+                messages.append({"MessageId": message_id, "ReceiptHandle": msg["receipt"], "Body": msg["Body"]})
+            self.receive_seconds.append(time.monotonic() - started)
+        if not messages:
+            time.sleep(0.05)  # stand in for a short poll round trip
+        return {"Messages": messages}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        with self.lock:
+            queue = self.queues[QueueUrl]
+            for message_id, msg in list(queue.items()):
+                if msg["receipt"] == ReceiptHandle:
+                    del queue[message_id]
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        now = time.monotonic()
+        with self.lock:
+            by_receipt = {msg["receipt"]: msg for msg in self.queues[QueueUrl].values()}
+            for entry in Entries:
+                if entry["ReceiptHandle"] in by_receipt:
+                    by_receipt[entry["ReceiptHandle"]]["visible_at"] = now + entry["VisibilityTimeout"]
+        return {"Successful": [{"Id": e["Id"]} for e in Entries], "Failed": []}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames=None, **kwargs):
+        now = time.monotonic()
+        with self.lock:
+            queue = self.queues[QueueUrl].values()
+            visible = sum(1 for msg in queue if msg["visible_at"] <= now)
+            return {"Attributes": {
+                "ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(len(queue) - visible),
+            }}
+
+
+class StatusAPI:
+    """Local HTTP server that accepts the worker's POST /videos/{id}/status calls."""
+
+    def __init__(self):
+        self.updates = deque()
+        updates = self.updates
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                updates.append((self.path, json.loads(body or b"{}")))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"message": "Status updated"}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+class DiskSampler:
+    """Tracks the peak size of the worker's scratch directory."""
+
+    def __init__(self, path, interval=0.2):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _usage(self):
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass  # removed while walking
+        return total
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self._usage())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def parse_source(spec):
+    name, size, seconds, video_codec, container = spec.split(":")
+    return {"name": name, "size": size, "seconds": float(seconds), "video_codec": video_codec, "container": container}
+
+
+def generate_source(source, path):
+    audio_codec = "libopus" if source["container"] == "webm" else "aac"
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={source['size']}:rate=30:duration={source['seconds']}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={source['seconds']}",
+        "-c:v", source["video_codec"], *GENERATOR_ARGS.get(source["video_codec"], []),
+        "-c:a", audio_codec, "-shortest", "-y", path,
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarise(results, wall_seconds, sqs, status_api, disk_peak):
+    stages = defaultdict(list)
+    for result in results:
+        for stage in result["stages"]:
+            stages[stage["stage"]].append(stage)
+
+    report = {
+        "jobs": len(results),
+        "wall_seconds": round(wall_seconds, 2),
+        "jobs_per_minute": round(len(results) / wall_seconds * 60, 2) if wall_seconds else 0,
+        "status_updates": len(status_api.updates),
+        "queue_receive_ms_p95": round(percentile(sqs.receive_seconds, 95) * 1000, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "peak_scratch_mb": round(disk_peak / (1024 * 1024), 1),
+        "stages": {},
+    }
+
+    for name, entries in sorted(stages.items()):
+        seconds = [e["seconds"] for e in entries]
+        total_bytes = sum(e["bytes"] for e in entries)
+        media = sum(e["media_seconds"] or 0 for e in entries)
+        summary = {
+            "count": len(entries),
+            "mean_s": round(statistics.mean(seconds), 3),
+            "p50_s": round(percentile(seconds, 50), 3),
+            "p95_s": round(percentile(seconds, 95), 3),
+        }
+        if total_bytes:
+            summary["mb_per_s"] = round(total_bytes / (1024 * 1024) / sum(seconds), 1) if sum(seconds) else None
+        if media:
+            summary["realtime_factor"] = round(media / sum(seconds), 2)
+        report["stages"][name] = summary
+    return report
+
+
+def print_report(report):
+    print()
+    print(f"jobs:              {report['jobs']} in {report['wall_seconds']}s ({report['jobs_per_minute']} jobs/min)")
+    print(f"status updates:    {report['status_updates']}")
+    print(f"queue receive p95: {report['queue_receive_ms_p95']} ms")
+    print(f"peak RSS:          {report['peak_rss_mb']} MB worker, {report['peak_child_rss_mb']} MB largest ffmpeg")
+    print(f"peak scratch disk: {report['peak_scratch_mb']} MB")
+    print()
+    print(f"{'stage':<10}{'count':>7}{'mean s':>10}{'p50 s':>10}{'p95 s':>10}{'MB/s':>9}{'x realtime':>12}")
+    for name, s in report["stages"].items():
+        print(
+            f"{name:<10}{s['count']:>7}{s['mean_s']:>10}{s['p50_s']:>10}{s['p95_s']:>10}"
+            f"{s.get('mb_per_s') or '':>9}{s.get('realtime_factor', ''):>12}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", action="append", help="name:WxH:seconds:video_codec:container (repeatable)")
+    parser.add_argument("--format", default="mp4", help="output format for every job")
+    parser.add_argument("--profile", default=None, help="encoding profile for every job")
+    parser.add_argument("--concurrency", type=int, default=None, help="job slots (default: worker.job_slots())")
+    parser.add_argument("--repeat", type=int, default=0, help="extra identical jobs per source (exercises the output cache)")
+    parser.add_argument("--streaming", action="store_true", help="run jobs in streaming mode")
+    parser.add_argument("--pipeline", action="store_true", help="use the prefetching pipelined runtime")
+    parser.add_argument("--source-cache", action="store_true", help="keep sources in an on-disk cache between jobs")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="worker-bench-")
+    store = os.path.join(root, "s3")
+    scratch = os.path.join(root, "scratch")
+    os.makedirs(scratch)
+
+    sqs = LocalSQS()
+    worker.s3 = LocalS3(store)
+    worker.sqs = sqs
+    worker.source_cache = None
+    if args.source_cache:
+        worker.source_cache = SourceCache(os.path.join(root, "source-cache"), worker.SOURCE_CACHE_MB * 1024 * 1024)
+    tempfile.tempdir = scratch
+
+    try:
+        tasks = []
+        for spec in args.source or DEFAULT_SOURCES:
+            source = parse_source(spec)
+            key = f"uploads/bench/{source['name']}.{source['container']}"
+            os.makedirs(os.path.dirname(os.path.join(store, key)), exist_ok=True)
+            print(f"[INFO] Generating {source['name']} ({source['size']}, {source['seconds']}s, {source['video_codec']})")
+            generate_source(source, os.path.join(store, key))
+
+            for _ in range(1 + args.repeat):
+                task = {
+                    "video_id": uuid.uuid4().hex,
+                    "input_key": key,
+                    "filename": source["name"],
+                    "output_format": args.format,
+                    "user_id": "bench",
+                }
+                if args.profile:
+                    task["profile"] = args.profile
+                if args.streaming:
+                    task["streaming"] = True
+                tasks.append(task)
+
+        for task in tasks:
+            sqs.send_message(QueueUrl=worker.QUEUE_URL, MessageBody=json.dumps(task))
+
+        results = []
+        worker.JOB_HOOKS.append(results.append)
+        slots = args.concurrency or worker.job_slots()
+
+        with StatusAPI() as status_api, DiskSampler(scratch) as disk:
+            worker.API_BASE = status_api.base_url
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=slots) as executor:
+                run = worker.run_pipeline if args.pipeline else worker.poll_queue
+                run(executor=executor, slots=slots, stop_when_idle=True)
+            wall_seconds = time.monotonic() - started
+
+        report = summarise(results, wall_seconds, sqs, status_api, disk.peak)
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if args.keep:
+            print(f"[INFO] Scratch kept at {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Prometheus text exposition of the worker's counters, gauges and histograms.
+# Everything is recorded in the polling process: job processes hand their stage
+# timings back in the job result.
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, key)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name, self.help, self.label_names = name, help, tuple(labels)
+        self.buckets = sorted(buckets)
+        self.series = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        with _lock:
+            # per-bucket counts (the last one is +Inf), then sum
+            series = self.series.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def samples(self):
+        bounds = [f"{b:g}" for b in self.buckets] + ["+Inf"]
+        for key, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.label_names + ('le',), key + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {total:.6f}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {cumulative}"
+
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+MBPS_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800)
+REALTIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+QUEUE_RECEIVE_SECONDS = Histogram(
+    "worker_queue_receive_seconds", "Time spent in SQS ReceiveMessage calls.", SECONDS_BUCKETS, ("result",)
+)
+STAGE_SECONDS = Histogram("worker_stage_seconds", "Duration of each job stage.", SECONDS_BUCKETS, ("stage",))
+STAGE_BYTES = Counter("worker_stage_bytes_total", "Bytes moved by each job stage.", ("stage",))
+TRANSFER_MBPS = Histogram(
+    "worker_transfer_megabytes_per_second", "S3 download/upload throughput per transfer.", MBPS_BUCKETS, ("stage",)
+)
+REALTIME_FACTOR = Histogram(
+    "worker_encode_realtime_factor", "Seconds of media encoded per wall-clock second.", REALTIME_BUCKETS, ("stage",)
+)
+JOBS = Counter("worker_jobs_total", "Finished jobs by type and outcome.", ("job_type", "outcome"))
+JOBS_IN_FLIGHT = Gauge("worker_jobs_in_flight", "Messages received and not yet finished.")
+CONCURRENCY_TARGET = Gauge("worker_concurrency_target", "Jobs the worker currently allows at once.")
+CPU_UTILIZATION = Gauge("worker_cpu_utilization", "CPU used as a fraction of the container's limit.")
+
+
+def observe_job(result):
+    JOBS.inc(job_type=result["job_type"], outcome=result["outcome"])
+    for stage in result["stages"]:
+        name, seconds = stage["stage"], stage["seconds"]
+        STAGE_SECONDS.observe(seconds, stage=name)
+        if stage["bytes"]:
+            STAGE_BYTES.inc(stage["bytes"], stage=name)
+            if name in ("download", "upload") and seconds > 0:
+                TRANSFER_MBPS.observe(stage["bytes"] / (1024 * 1024) / seconds, stage=name)
+        if stage["media_seconds"] and seconds > 0:
+            REALTIME_FACTOR.observe(stage["media_seconds"] / seconds, stage=name)
+
+
+def render():
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics available on :{port}/metrics")
+    return server
+
+
+def write_snapshots(path, interval):
+    """Rewrite path with the current metrics every interval seconds, for scrapers that read files."""
+    def run():
+        while True:
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as f:
+                f.write(render())
+            os.replace(tmp, path)
+            if stopped.wait(interval):
+                return
+
+    stopped = threading.Event()
+    threading.Thread(target=run, daemon=True).start()
+    return stopped
@@ -0,0 +1,98 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def locked(path, blocking=True):
+    """flock() a lock file; yields False instead of waiting when blocking is off and it is held."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+class SourceCache:
+    """Byte-bounded LRU cache of source objects on scratch disk.
+
+    Entries are named by a hash of bucket/key/ETag, so a changed object is a
+    new entry. Jobs get a hard link to the entry, which stays valid after the
+    entry is evicted and can be removed like any other scratch file. Locks are
+    flock()s on files next to each entry, so concurrent threads and worker
+    processes share the cache safely; an entry's mtime is its last use.
+    """
+
+    def __init__(self, directory, budget_bytes):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def fetch(self, name, download, dest):
+        """Place the object at dest, calling download(path) on a miss. Returns True on a hit."""
+        entry = os.path.join(self.directory, hashlib.sha256(name.encode()).hexdigest())
+
+        with locked(f"{entry}.lock"):
+            try:
+                os.utime(entry)
+                self._link(entry, dest)
+                return True
+            except FileNotFoundError:
+                pass
+
+            partial = f"{entry}.{uuid.uuid4().hex}.partial"
+            try:
+                download(partial)
+                os.replace(partial, entry)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            self._link(entry, dest)
+
+        self.evict()
+        return False
+
+    def _link(self, entry, dest):
+        tmp = f"{dest}.{uuid.uuid4().hex}"
+        try:
+            os.link(entry, tmp)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            # scratch dir on another filesystem
+            shutil.copyfile(entry, tmp)
+        os.replace(tmp, dest)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its budget, skipping ones in use."""
+        with locked(os.path.join(self.directory, ".evict.lock")):
+            entries = []
+            for name in os.listdir(self.directory):
+                if "." in name:
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.budget_bytes:
+                    break
+                with locked(f"{path}.lock", blocking=False) as held:
+                    if not held:
+                        continue
+                    os.remove(path)
+                    os.remove(f"{path}.lock")
+                total -= size
+                print(f"[INFO] Evicted {size} byte source from cache")
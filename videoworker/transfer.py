@@ -0,0 +1,172 @@
+"""Parallel S3 transfers for large media.
+
+Downloads split the object into PART_SIZE ranges fetched by CONCURRENCY threads
+and written in place; uploads above PART_SIZE go up as a multipart upload with
+the same concurrency. Each part is retried on its own, so one dropped
+connection doesn't restart a multi-GB transfer. Every transfer returns the
+bandwidth it achieved; run this module directly to measure it for an instance
+type:
+
+    python transfer.py --bucket BUCKET download uploads/user/big.mov --concurrency 4 8 16
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+
+PART_SIZE = int(os.environ.get("TRANSFER_PART_MB", 16)) * 1024 * 1024
+CONCURRENCY = int(os.environ.get("TRANSFER_CONCURRENCY", 8))
+RETRIES = int(os.environ.get("TRANSFER_RETRIES", 3))
+
+# Errors a retry can't fix, e.g. the object changed under an IfMatch
+FATAL_ERRORS = {"404", "NoSuchKey", "NoSuchUpload", "403", "AccessDenied", "412", "PreconditionFailed"}
+
+
+def with_retries(fn, *args):
+    for attempt in range(RETRIES + 1):
+        try:
+            return fn(*args)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in FATAL_ERRORS or attempt == RETRIES:
+                raise
+            error = e
+        except Exception as e:
+            if attempt == RETRIES:
+                raise
+            error = e
+        print(f"[WARN] Transfer part failed ({error}), retry {attempt + 1}/{RETRIES}")
+        time.sleep(0.5 * 2 ** attempt)
+
+
+def parts(size, part_size):
+    return [(offset, min(offset + part_size, size)) for offset in range(0, size, part_size)] or [(0, 0)]
+
+
+def report(action, key, nbytes, seconds, part_count, concurrency):
+    mb_per_s = nbytes / (1024 * 1024) / seconds if seconds > 0 else 0
+    print(
+        f"[INFO] {action} {key}: {nbytes / (1024 * 1024):.1f} MB in {seconds:.2f}s "
+        f"({mb_per_s:.1f} MB/s, {part_count} part(s), {concurrency} stream(s))"
+    )
+    return {"bytes": nbytes, "seconds": seconds, "mb_per_s": mb_per_s}
+
+
+def download(s3, bucket, key, path, etag=None, part_size=PART_SIZE, concurrency=CONCURRENCY):
+    """Fetch key into path with parallel ranged GETs, pinned to one ETag so parts can't mix versions."""
+    started = time.monotonic()
+    head = s3.head_object(Bucket=bucket, Key=key, **({"IfMatch": etag} if etag else {}))
+    size = head["ContentLength"]
+    match = {"IfMatch": etag or head["ETag"]}
+    ranges = parts(size, part_size)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+
+        def fetch(start, end):
+            if end == start:
+                return
+            body = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", **match)["Body"]
+            data = body.read()
+            if len(data) != end - start:
+                raise IOError(f"short read for bytes {start}-{end - 1}: got {len(data)}")
+            os.pwrite(fd, data, start)
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(ranges))) as pool:
+            for future in [pool.submit(with_retries, fetch, start, end) for start, end in ranges]:
+                future.result()
+    finally:
+        os.close(fd)
+
+    return report("Downloaded", key, size, time.monotonic() - started, len(ranges), concurrency)
+
+
+def upload(s3, bucket, key, path, extra_args=None, part_size=PART_SIZE, concurrency=CONCURRENCY):
+    """Upload path to key, as a concurrent multipart upload when it is larger than one part."""
+    started = time.monotonic()
+    extra_args = extra_args or {}
+    size = os.path.getsize(path)
+
+    if size <= part_size:
+        with open(path, "rb") as f:
+            data = f.read()
+        with_retries(lambda: s3.put_object(Bucket=bucket, Key=key, Body=data, **extra_args))
+        return report("Uploaded", key, size, time.monotonic() - started, 1, 1)
+
+    ranges = parts(size, part_size)
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)["UploadId"]
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def send(number, start, end):
+            resp = s3.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                Body=os.pread(fd, end - start, start)
+            )
+            return {"PartNumber": number, "ETag": resp["ETag"]}
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(ranges))) as pool:
+            futures = [
+                pool.submit(with_retries, send, number, start, end)
+                for number, (start, end) in enumerate(ranges, start=1)
+            ]
+            uploaded = [future.result() for future in futures]
+
+        s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": uploaded}
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    finally:
+        os.close(fd)
+
+    return report("Uploaded", key, size, time.monotonic() - started, len(ranges), concurrency)
+
+
+def main():
+    import boto3
+    from botocore.config import Config
+
+    parser = argparse.ArgumentParser(description="Measure S3 transfer bandwidth for part size / concurrency settings")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--region", default="ap-southeast-2")
+    parser.add_argument("--part-mb", type=int, nargs="+", default=[PART_SIZE // (1024 * 1024)])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[CONCURRENCY])
+    parser.add_argument("action", choices=["download", "upload"])
+    parser.add_argument("key", help="object to download, or key to upload a scratch file to")
+    parser.add_argument("--upload-mb", type=int, default=1024, help="size of the scratch file for uploads")
+    args = parser.parse_args()
+
+    s3 = boto3.client(
+        "s3", region_name=args.region, config=Config(max_pool_connections=max(args.concurrency) + 2)
+    )
+    path = tempfile.NamedTemporaryFile(delete=False).name
+    try:
+        if args.action == "upload":
+            with open(path, "wb") as f:
+                for _ in range(args.upload_mb):
+                    f.write(os.urandom(1024 * 1024))
+
+        results = []
+        for part_mb in args.part_mb:
+            for concurrency in args.concurrency:
+                if args.action == "download":
+                    stats = download(s3, args.bucket, args.key, path, None, part_mb * 1024 * 1024, concurrency)
+                else:
+                    stats = upload(s3, args.bucket, args.key, path, None, part_mb * 1024 * 1024, concurrency)
+                results.append((part_mb, concurrency, stats["mb_per_s"]))
+
+        print()
+        print("part MB  streams  MB/s")
+        for part_mb, concurrency, mb_per_s in sorted(results, key=lambda r: -r[2]):
+            print(f"{part_mb:>7}  {concurrency:>7}  {mb_per_s:.1f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
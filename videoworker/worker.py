@@ -4,27 +4,1012 @@ import json
 import subprocess
 import tempfile
 import os
+import multiprocessing
+import threading
+import re
+import uuid
+import hashlib
+import glob
+import math
+import random
+from contextlib import contextmanager
 import requests
+import ffmpeg
+from collections import deque
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from profiles import resolve_profile, ffmpeg_args, audio_args, cache_params
+from source_cache import SourceCache
+import metrics
+import transfer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 REGION = "ap-southeast-2"
-QUEUE_URL = "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n11715910-a2"
-S3_BUCKET = "n11715910-a2"
-API_BASE = "https://transcoding-n11715910.cab432.com"
+QUEUE_URL = os.environ.get("QUEUE_URL", "https://sqs.ap-southeast-2.amazonaws.com/901444280953/n11715910-a2")
+S3_BUCKET = os.environ.get("S3_BUCKET", "n11715910-a2")
+API_BASE = os.environ.get("API_BASE", "https://transcoding-n11715910.cab432.com")
+
+# Priority lanes: the API routes each job to a lane by its estimated cost and
+# the worker polls lanes in a weighted random order, so short jobs are picked up
+# quickly while large ones still make progress. Unset lanes share QUEUE_URL.
+LANE_QUEUES = {
+    "small": os.environ.get("QUEUE_URL_SMALL", QUEUE_URL),
+    "medium": os.environ.get("QUEUE_URL_MEDIUM", QUEUE_URL),
+    "large": os.environ.get("QUEUE_URL_LARGE", QUEUE_URL),
+}
+LANE_WEIGHTS = {
+    "small": int(os.environ.get("LANE_WEIGHT_SMALL", 6)),
+    "medium": int(os.environ.get("LANE_WEIGHT_MEDIUM", 3)),
+    "large": int(os.environ.get("LANE_WEIGHT_LARGE", 1)),
+}
+
+# Concurrent mode: "adaptive" starts from the "auto" size and lets the controller
+# move it between the bounds below, "auto" sizes the pool once from cores and
+# memory, a number pins it.
+WORKER_CONCURRENCY = os.environ.get("WORKER_CONCURRENCY", "adaptive")
+JOB_MEMORY_MB = int(os.environ.get("JOB_MEMORY_MB", 1024))
+MAX_MESSAGES_PER_POLL = 10
+
+# Adaptive concurrency. Each CONCURRENCY_INTERVAL the controller votes to add a
+# job (CPU below CPU_LOW, every slot busy, room for another JOB_MEMORY_MB) or drop
+# one (memory nearly gone, or CPU above CPU_HIGH while total encode throughput is
+# lower than it was with one job fewer). A vote has to repeat
+# CONCURRENCY_PATIENCE times before the target moves; a level that lost
+# throughput is not retried for CONCURRENCY_CEILING_TTL seconds.
+CONCURRENCY_MIN = int(os.environ.get("CONCURRENCY_MIN", 1))
+CONCURRENCY_MAX = int(os.environ.get("CONCURRENCY_MAX", 0)) or None
+CONCURRENCY_INTERVAL = float(os.environ.get("CONCURRENCY_INTERVAL", 30))
+CONCURRENCY_PATIENCE = int(os.environ.get("CONCURRENCY_PATIENCE", 2))
+CONCURRENCY_CPU_LOW = float(os.environ.get("CONCURRENCY_CPU_LOW", 0.75))
+CONCURRENCY_CPU_HIGH = float(os.environ.get("CONCURRENCY_CPU_HIGH", 0.95))
+CONCURRENCY_CEILING_TTL = float(os.environ.get("CONCURRENCY_CEILING_TTL", 600))
+
+# Messages start with a short lease so a crashed worker's jobs come back quickly;
+# the heartbeat keeps extending the lease while the job is still running.
+VISIBILITY_TIMEOUT = int(os.environ.get("VISIBILITY_TIMEOUT", 60))
+HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", 20))
+
+# Streaming mode pipes S3 -> ffmpeg -> S3 without scratch files
+STREAMING_MODE = os.environ.get("STREAMING_MODE", "0") == "1"
+STREAM_READ_SIZE = 8 * 1024 * 1024
+STREAM_PART_SIZE = 16 * 1024 * 1024  # S3 multipart parts must be >= 5 MiB
+
+# Muxer settings that can be written to a non-seekable pipe
+STREAM_MUXERS = {
+    "mp4": ["-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof"],
+    "mov": ["-f", "mov", "-movflags", "frag_keyframe+empty_moov+default_base_moof"],
+    "mkv": ["-f", "matroska"],
+    "webm": ["-f", "webm"],
+}
+
+# Progress updates are sent at most every PROGRESS_INTERVAL seconds and only
+# when the job has moved at least PROGRESS_MIN_STEP percent.
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 5))
+PROGRESS_MIN_STEP = float(os.environ.get("PROGRESS_MIN_STEP", 1))
+STDERR_TAIL_LINES = 50
+
+# Keys ffmpeg writes for "-progress"; anything else on stderr is a log line
+PROGRESS_KEYS = {
+    "frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+    "dup_frames", "drop_frames", "speed", "progress",
+}
+# plus one per output video stream, e.g. stream_0_0_q=28.0
+STREAM_PROGRESS_KEY = re.compile(r"stream_\d+_\d+_\w+$")
+
+# Encoders for ladder renditions in containers that can't carry H.264/AAC
+CONTAINER_CODECS = {
+    "webm": ("libvpx-vp9", "libopus"),
+}
+DEFAULT_CODECS = ("libx264", "aac")
+
+# Containers that can take H.264/AAC as-is, so matching sources are remuxed
+REMUX_CONTAINERS = {"mp4", "mov", "mkv"}
+REMUX_SOURCE_CODECS = ("h264", "aac")
+
+# Segmented (adaptive streaming) outputs. Media segments are uploaded as soon as
+# ffmpeg closes them; playlists and init segments go up once the encode ends.
+SEGMENT_DURATION = os.environ.get("SEGMENT_DURATION", "6")
+SEGMENT_UPLOAD_THREADS = int(os.environ.get("SEGMENT_UPLOAD_THREADS", 8))
+SEGMENTED_FORMATS = {
+    "hls": {
+        "manifest": "index.m3u8",
+        "segment": re.compile(r"^seg_\d+\.ts$"),
+        "args": lambda out_dir: [
+            "-f", "hls", "-hls_time", SEGMENT_DURATION, "-hls_playlist_type", "vod",
+            # temp_file makes ffmpeg write seg_N.ts.tmp and rename it once closed
+            "-hls_flags", "temp_file+independent_segments",
+            "-hls_segment_filename", os.path.join(out_dir, "seg_%05d.ts"),
+        ],
+    },
+    "dash": {
+        "manifest": "manifest.mpd",
+        "segment": re.compile(r"^chunk-\d+-\d+\.m4s$"),
+        "args": lambda out_dir: [
+            "-f", "dash", "-seg_duration", SEGMENT_DURATION,
+            # explicit SegmentList so the API can presign every segment URL
+            "-use_template", "0", "-use_timeline", "0",
+            "-init_seg_name", "init-$RepresentationID$.m4s",
+            "-media_seg_name", "chunk-$RepresentationID$-$Number%05d$.m4s",
+        ],
+    },
+}
+# Pipelined runtime: prefetch upcoming sources while earlier jobs encode and
+# upload finished outputs in the background. Prefetching stops once
+# PREFETCH_SCRATCH_MB of downloaded-but-unencoded sources are on disk.
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "0") == "1"
+PREFETCH_DEPTH = int(os.environ.get("PREFETCH_DEPTH", 2))
+PREFETCH_SCRATCH_MB = int(os.environ.get("PREFETCH_SCRATCH_MB", 4096))
+UPLOAD_THREADS = int(os.environ.get("UPLOAD_THREADS", 4))
+
+# Long sources are cut at keyframes into CHUNK_DURATION-second pieces that are
+# encoded by any worker in the fleet and then joined with stream copy.
+CHUNKED_MIN_DURATION = float(os.environ.get("CHUNKED_MIN_DURATION", 600))
+CHUNK_DURATION = os.environ.get("CHUNK_DURATION", "120")
+CHUNKABLE_FORMATS = {"mp4", "mov", "mkv", "webm"}
+
+# Seek previews: a poster frame and SPRITE_GRID sheets of SPRITE_TILE thumbnails
+# with a WebVTT index. They are extra outputs of the encode's own ffmpeg run, so
+# the source is downloaded and decoded once for both.
+PREVIEWS = os.environ.get("PREVIEWS", "1") == "1"
+POSTER_WIDTH = int(os.environ.get("POSTER_WIDTH", 640))
+SPRITE_INTERVAL = float(os.environ.get("SPRITE_INTERVAL", 10))
+SPRITE_MAX_FRAMES = 300
+SPRITE_TILE = (160, 90)
+SPRITE_GRID = (10, 10)
+
+# Sources kept on scratch disk so repeat jobs on the same upload skip S3.
+# SOURCE_CACHE_MB=0 turns the cache off.
+SOURCE_CACHE_DIR = os.environ.get("SOURCE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "source-cache"))
+SOURCE_CACHE_MB = int(os.environ.get("SOURCE_CACHE_MB", 10240))
+
+# Prometheus text metrics on METRICS_PORT (0 turns the endpoint off), and/or
+# rewritten to METRICS_FILE every METRICS_SNAPSHOT_INTERVAL seconds
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_SNAPSHOT_INTERVAL = float(os.environ.get("METRICS_SNAPSHOT_INTERVAL", 15))
+
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".mpd": "application/dash+xml",
+    ".m4s": "video/iso.segment",
+    ".jpg": "image/jpeg",
+    ".vtt": "text/vtt",
+}
 
 sqs = boto3.client('sqs', region_name=REGION)
-s3 = boto3.client('s3', region_name=REGION)
+# room for every parallel transfer part plus the job's other S3 calls
+s3 = boto3.client('s3', region_name=REGION, config=Config(max_pool_connections=transfer.CONCURRENCY * 2 + 4))
+source_cache = SourceCache(SOURCE_CACHE_DIR, SOURCE_CACHE_MB * 1024 * 1024) if SOURCE_CACHE_MB else None
+
+# Called in the polling process with each finished job's result
+JOB_HOOKS = []
+
+# Per-job stage timings, collected in whichever thread runs the job
+_job = threading.local()
+
+
+def record_stage(stage, seconds, nbytes=0, media_seconds=None):
+    stages = getattr(_job, "stages", None)
+    if stages is not None:
+        stages.append({"stage": stage, "seconds": seconds, "bytes": nbytes, "media_seconds": media_seconds})
+
 
-def update_api(video_id, status, progress=0, output_format=None):
+def collect_stages(fn, *args, **kwargs):
+    """Run fn on a helper thread, returning the stages it recorded for the job's thread to add."""
+    _job.stages = []
     try:
-        payload = {"status": status, "progress": progress}
+        fn(*args, **kwargs)
+        return _job.stages
+    finally:
+        _job.stages = None
+
+
+def add_stages(recorded):
+    stages = getattr(_job, "stages", None)
+    if stages is not None:
+        stages.extend(recorded)
+
+
+@contextmanager
+def timed_stage(stage):
+    started = time.monotonic()
+    info = {"bytes": 0, "media_seconds": None}
+    try:
+        yield info
+    finally:
+        record_stage(stage, time.monotonic() - started, info["bytes"], info["media_seconds"])
+
+
+def update_api(video_id, status, progress=0, output_format=None, user_id=None, **fields):
+    if status == "failed":
+        _job.failed = True
+    with timed_stage("status"):
+        notify_api(video_id, status, progress, output_format, user_id, **fields)
+
+
+def notify_api(video_id, status, progress=0, output_format=None, user_id=None, **fields):
+    try:
+        payload = {"status": status, "progress": progress, **fields}
         if output_format:
             payload["format"] = output_format
+        if user_id:
+            payload["user_id"] = user_id
         r = requests.post(f"{API_BASE}/videos/{video_id}/status", json=payload, timeout=10)
         r.raise_for_status()
     except Exception as e:
         print(f"[WARN] Failed to notify API: {e}")
 
-def process_message(task):
+def report_failure(video_id, user_id, filename, tail):
+    error = "\n".join(tail)
+    print(f"[ERROR] ffmpeg failed for {filename}:\n{error}")
+    update_api(video_id, "failed", 0, user_id=user_id, error=error[-500:])
+
+
+class ProgressReporter:
+    def __init__(self, video_id, user_id, duration):
+        self.video_id = video_id
+        self.user_id = user_id
+        self.duration = duration
+        self.out_time = 0.0
+        self.speed = None
+        self.last_sent_at = 0.0
+        self.last_percent = 0.0
+
+    def handle(self, key, value):
+        if key == "out_time_us" and value.isdigit():
+            self.out_time = int(value) / 1_000_000
+        elif key == "speed" and value.endswith("x"):
+            try:
+                self.speed = float(value[:-1])
+            except ValueError:
+                pass
+        elif key == "progress":
+            # ffmpeg ends every progress block with "progress=continue|end"
+            self.report()
+
+    def report(self):
+        if not self.duration:
+            return
+        percent = min(99.0, self.out_time / self.duration * 100)
+        now = time.monotonic()
+        if now - self.last_sent_at < PROGRESS_INTERVAL or percent - self.last_percent < PROGRESS_MIN_STEP:
+            return
+
+        self.last_sent_at = now
+        self.last_percent = percent
+        fields = {"speed": self.speed} if self.speed is not None else {}
+        update_api(self.video_id, "transcoding", round(percent), user_id=self.user_id, **fields)
+
+
+def probe_source(source):
+    try:
+        return ffmpeg.probe(source)
+    except Exception as e:
+        print(f"[WARN] Could not probe {source}: {e}")
+        return None
+
+
+def media_duration(info):
+    try:
+        return float(info["format"]["duration"])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def can_remux(info, output_format):
+    """True when the source already carries the codecs the default profile would encode to."""
+    if not info or output_format not in REMUX_CONTAINERS:
+        return False
+
+    streams = info.get("streams", [])
+    video = [
+        st for st in streams
+        if st.get("codec_type") == "video" and not st.get("disposition", {}).get("attached_pic")
+    ]
+    audio = [st for st in streams if st.get("codec_type") == "audio"]
+
+    video_codec, audio_codec = REMUX_SOURCE_CODECS
+    return (
+        bool(video) and video[0].get("codec_name") == video_codec
+        and all(st.get("codec_name") == audio_codec for st in audio[:1])
+    )
+
+
+def codec_args(remux, profile, output_format=None):
+    if not remux:
+        return ffmpeg_args(profile)
+    args = ["-map", "0:v:0", "-map", "0:a:0?", "-c", "copy"]
+    if output_format in ("mp4", "mov"):
+        args += ["-movflags", "+faststart"]
+    return args
+
+
+def ffmpeg_command(args):
+    return ["ffmpeg", "-hide_banner", "-nostats", "-progress", "pipe:2", *args]
+
+
+def watch_ffmpeg(stderr, reporter=None, tail=None):
+    """Consume ffmpeg's stderr, feeding progress to the reporter and keeping a bounded log tail."""
+    if tail is None:
+        tail = deque(maxlen=STDERR_TAIL_LINES)
+    for raw in stderr:
+        line = raw.decode(errors="replace").rstrip()
+        key, sep, value = line.partition("=")
+        if sep and (key in PROGRESS_KEYS or STREAM_PROGRESS_KEY.match(key)):
+            if reporter:
+                reporter.handle(key, value.strip())
+        elif line:
+            tail.append(line)
+    return tail
+
+
+def run_ffmpeg(args, reporter=None):
+    with timed_stage("encode") as stage:
+        process = subprocess.Popen(ffmpeg_command(args), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        tail = watch_ffmpeg(process.stderr, reporter)
+        returncode = process.wait()
+        if reporter and returncode == 0:
+            stage["media_seconds"] = reporter.duration
+    return returncode, tail
+
+
+def feed_source(input_key, process, failed):
+    """Write the source into ffmpeg's stdin in ranged GETs, each retried from where it stopped.
+
+    On a failure ffmpeg is killed and failed is set: closing stdin would look
+    like the end of the input and ffmpeg would finish a truncated video.
+    """
+    pipe = process.stdin
+    position = 0
+
+    def feed(end):
+        nonlocal position
+        body = s3.get_object(Bucket=S3_BUCKET, Key=input_key, Range=f"bytes={position}-{end}", IfMatch=etag)["Body"]
+        for chunk in body.iter_chunks(1024 * 1024):
+            try:
+                pipe.write(chunk)
+            except BrokenPipeError:
+                return False  # ffmpeg stopped reading, its exit code tells us why
+            position += len(chunk)
+        return True
+
+    try:
+        head = s3.head_object(Bucket=S3_BUCKET, Key=input_key)
+        size, etag = head["ContentLength"], head["ETag"]
+        while position < size:
+            if not transfer.with_retries(feed, min(position + STREAM_READ_SIZE, size) - 1):
+                return
+    except Exception as e:
+        print(f"[ERROR] Failed to stream source {input_key}: {e}")
+        failed.set()
+        process.kill()
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+def upload_parts(pipe, output_key, upload_id):
+    parts = []
+    while True:
+        data = pipe.read(STREAM_PART_SIZE)
+        if not data:
+            break
+        part_number = len(parts) + 1
+        resp = s3.upload_part(
+            Bucket=S3_BUCKET, Key=output_key, UploadId=upload_id,
+            PartNumber=part_number, Body=data
+        )
+        parts.append({"PartNumber": part_number, "ETag": resp["ETag"]})
+    return parts
+
+
+def stream_transcode(input_key, output_key, output_format, codecs, reporter=None):
+    """Transcode straight from S3 to S3, overlapping download, encode and upload."""
+    args = ["-i", "pipe:0", *codecs, *STREAM_MUXERS[output_format], "pipe:1"]
+    process = subprocess.Popen(ffmpeg_command(args), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    feed_failed = threading.Event()
+    feeder = threading.Thread(target=feed_source, args=(input_key, process, feed_failed), daemon=True)
+    drainer = threading.Thread(target=watch_ffmpeg, args=(process.stderr, reporter, tail), daemon=True)
+    feeder.start()
+    drainer.start()
+
+    upload_id = s3.create_multipart_upload(Bucket=S3_BUCKET, Key=output_key)["UploadId"]
+    try:
+        # download, encode and upload overlap here, so they are timed as one stage
+        with timed_stage("stream") as stage:
+            parts = upload_parts(process.stdout, output_key, upload_id)
+            returncode = process.wait()
+            feeder.join()
+            drainer.join()
+            if reporter and returncode == 0:
+                stage["media_seconds"] = reporter.duration
+
+        if returncode != 0 or not parts or feed_failed.is_set():
+            print(f"[WARN] Streaming transcode failed for {input_key}: {' | '.join(list(tail)[-5:])}")
+            s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=output_key, UploadId=upload_id)
+            return False
+
+        s3.complete_multipart_upload(
+            Bucket=S3_BUCKET, Key=output_key, UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+        return True
+    except Exception:
+        process.kill()
+        s3.abort_multipart_upload(Bucket=S3_BUCKET, Key=output_key, UploadId=upload_id)
+        raise
+
+
+def source_etag(input_key):
+    return s3.head_object(Bucket=S3_BUCKET, Key=input_key)["ETag"].strip('"')
+
+
+def cached_output_key(etag, params, suffix=""):
+    """Content-addressed output key: same source bytes + same encode settings = same key."""
+    digest = hashlib.sha256(json.dumps({"source": etag, **params}, sort_keys=True).encode()).hexdigest()
+    return f"transcoded/{digest}{suffix}"
+
+
+def rendition_key(etag, rendition):
+    settings = {k: v for k, v in rendition.items() if k != "name"}
+    return cached_output_key(etag, settings, f".{rendition['format']}")
+
+
+def segmented_prefix(etag, profile_name, output_format):
+    return cached_output_key(etag, {
+        **cache_params(profile_name, output_format), "segment_duration": SEGMENT_DURATION,
+    })
+
+
+def outputs_cached(task):
+    """Whether run_job would find every output of task cached, and so never read its source."""
+    if task.get("job_type") in ("chunk", "concat"):
+        return False
+    etag = source_etag(task["input_key"])
+    if task.get("job_type") == "ladder":
+        return all(object_exists(rendition_key(etag, r)) for r in task["renditions"])
+
+    try:
+        profile_name, _, container = resolve_profile(task.get("profile"), task["output_format"])
+    except ValueError:
+        return True  # rejected before the source is read
+    if container in SEGMENTED_FORMATS:
+        return object_exists(f"{segmented_prefix(etag, profile_name, container)}/{SEGMENTED_FORMATS[container]['manifest']}")
+    return object_exists(cached_output_key(etag, cache_params(profile_name, container), f".{container}"))
+
+
+def object_exists(key):
+    try:
+        s3.head_object(Bucket=S3_BUCKET, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+def download_to(key, path, etag=None):
+    # IfMatch makes sure a cached copy really has the ETag it is filed under
+    with timed_stage("download") as stage:
+        stage["bytes"] = transfer.download(s3, S3_BUCKET, key, path, etag)["bytes"]
+
+
+def upload_output(path, key, ExtraArgs=None):
+    with timed_stage("upload") as stage:
+        stage["bytes"] = transfer.upload(s3, S3_BUCKET, key, path, ExtraArgs)["bytes"]
+
+
+def download_source(input_key):
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_in:
+        path = tmp_in.name
+
+    if source_cache is None:
+        download_to(input_key, path)
+        return path
+
+    etag = source_etag(input_key)
+    hit = source_cache.fetch(
+        f"{S3_BUCKET}/{input_key}/{etag}", lambda partial: download_to(input_key, partial, etag), path
+    )
+    if hit:
+        print(f"[INFO] Source cache hit for {input_key}")
+    return path
+
+
+def fetch_source(task):
+    """Local copy of the job's source, reusing one the pipeline already prefetched."""
+    path, _job.source_path = getattr(_job, "source_path", None), None
+    return path or download_source(task["input_key"])
+
+
+def content_type_args(path):
+    content_type = CONTENT_TYPES.get(os.path.splitext(path)[1])
+    return {"ExtraArgs": {"ContentType": content_type}} if content_type else {}
+
+
+def publish(video_id, uploads, done):
+    try:
+        for output_path, output_key in uploads:
+            print(f"[INFO] Uploading transcoded file to S3: {output_key}")
+            upload_output(output_path, output_key, **content_type_args(output_path))
+    finally:
+        for output_path, _ in uploads:
+            os.remove(output_path)
+    update_api(video_id, "done", 100, **done)
+
+
+def finish_job(video_id, uploads, **done):
+    """Upload outputs and mark the job done, or hand both to the pipeline's upload stage."""
+    if getattr(_job, "defer_publish", False):
+        _job.publish = (video_id, uploads, done)
+    else:
+        publish(video_id, uploads, done)
+
+
+def wants_previews(info, profile):
+    if not PREVIEWS or profile.get("audio_only") or not info:
+        return False
+    return any(
+        st.get("codec_type") == "video" and not st.get("disposition", {}).get("attached_pic")
+        for st in info.get("streams", [])
+    )
+
+
+def sprite_interval(duration):
+    return max(SPRITE_INTERVAL, (duration or 0) / SPRITE_MAX_FRAMES)
+
+
+def preview_args(base, duration):
+    """Extra ffmpeg outputs writing {base}_poster.jpg and {base}_sprite_NNN.jpg."""
+    width, height = SPRITE_TILE
+    cols, rows = SPRITE_GRID
+    poster_at = min(duration * 0.1, 10) if duration else 0
+    sprite_filter = (
+        f"fps=1/{sprite_interval(duration)},"
+        f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,tile={cols}x{rows}"
+    )
+    return [
+        "-map", "0:v:0", "-ss", f"{poster_at:.2f}", "-frames:v", "1",
+        "-vf", f"scale={POSTER_WIDTH}:-2", "-q:v", "3", "-y", f"{base}_poster.jpg",
+        "-map", "0:v:0", "-vf", sprite_filter, "-q:v", "5", "-y", f"{base}_sprite_%03d.jpg",
+    ]
+
+
+def preview_base():
+    # unique path prefix in the temp dir for one job's preview files
+    with tempfile.NamedTemporaryFile(prefix="preview_") as tmp:
+        return tmp.name
+
+
+def preview_outputs(base, video_id, duration):
+    """Write the sprites' WebVTT index and return (uploads, keys) for every preview file."""
+    prefix = f"thumbnails/{video_id}"
+    sprites = sorted(glob.glob(f"{base}_sprite_*.jpg"))
+    if not os.path.exists(f"{base}_poster.jpg") or not sprites:
+        remove_previews(base)
+        return [], None
+
+    width, height = SPRITE_TILE
+    cols, rows = SPRITE_GRID
+    interval = sprite_interval(duration)
+    frames = min(math.ceil((duration or interval) / interval), len(sprites) * cols * rows)
+
+    def stamp(seconds):
+        return time.strftime("%H:%M:%S", time.gmtime(seconds)) + f".{int(seconds * 1000) % 1000:03d}"
+
+    cues = ["WEBVTT", ""]
+    for i in range(frames):
+        start = i * interval
+        end = min(start + interval, duration) if duration else start + interval
+        sheet = os.path.basename(sprites[i // (cols * rows)]).rsplit("_", 1)[1]
+        x, y = (i % cols) * width, (i // cols % rows) * height
+        cues += [f"{stamp(start)} --> {stamp(end)}", f"sprite_{sheet}#xywh={x},{y},{width},{height}", ""]
+    with open(f"{base}_sprites.vtt", "w") as f:
+        f.write("\n".join(cues))
+
+    uploads = [(f"{base}_poster.jpg", f"{prefix}/poster.jpg"), (f"{base}_sprites.vtt", f"{prefix}/sprites.vtt")]
+    uploads += [(path, f"{prefix}/sprite_{path.rsplit('_', 1)[1]}") for path in sprites]
+    keys = {
+        "poster_key": f"{prefix}/poster.jpg",
+        "sprites_key": f"{prefix}/sprites.vtt",
+    }
+    return uploads, keys
+
+
+def remove_previews(base):
+    for path in glob.glob(f"{base}_*"):
+        os.remove(path)
+
+
+def ladder_args(input_path, renditions, output_paths):
+    """Build one ffmpeg invocation that decodes once and splits into every rendition."""
+    count = len(renditions)
+    graph = [f"[0:v]split={count}" + "".join(f"[v{i}]" for i in range(count))]
+    graph += [f"[v{i}]scale=-2:{r['height']}[out{i}]" for i, r in enumerate(renditions)]
+
+    args = ["-i", input_path, "-filter_complex", ";".join(graph)]
+    for i, (rendition, output_path) in enumerate(zip(renditions, output_paths)):
+        vcodec, acodec = CONTAINER_CODECS.get(rendition["format"], DEFAULT_CODECS)
+        args += [
+            "-map", f"[out{i}]", "-map", "0:a?",
+            "-c:v", vcodec, "-b:v", rendition["video_bitrate"],
+            "-c:a", acodec, "-b:a", rendition.get("audio_bitrate", "128k"),
+            "-y", output_path,
+        ]
+    return args
+
+
+def process_ladder(task):
+    video_id = task["video_id"]
+    filename = task["filename"]
+    user_id = task["user_id"]
+    renditions = task["renditions"]
+
+    print(f"[INFO] Processing video {video_id} into {len(renditions)} renditions")
+    update_api(video_id, "transcoding", 0, user_id=user_id)
+
+    etag = source_etag(task["input_key"])
+    outputs = []
+    for rendition in renditions:
+        outputs.append({**rendition, "key": rendition_key(etag, rendition)})
+
+    # Only renditions nobody has produced from these exact bytes need encoding
+    pending = [output for output in outputs if not object_exists(output["key"])]
+    if not pending:
+        print(f"[INFO] All renditions of {video_id} already cached")
+        update_api(video_id, "done", 100, task["output_format"], user_id=user_id, outputs=outputs)
+        return
+
+    input_path = fetch_source(task)
+    output_paths = [
+        tempfile.NamedTemporaryFile(delete=False, suffix=f".{r['format']}").name for r in pending
+    ]
+
+    info = probe_source(input_path)
+    duration = media_duration(info)
+    args = ladder_args(input_path, pending, output_paths)
+    base = preview_base() if wants_previews(info, {}) else None
+    if base:
+        args += preview_args(base, duration)
+
+    try:
+        reporter = ProgressReporter(video_id, user_id, duration)
+        returncode, tail = run_ffmpeg(args, reporter)
+    finally:
+        os.remove(input_path)
+
+    if returncode != 0:
+        report_failure(video_id, user_id, filename, tail)
+        for path in output_paths:
+            os.remove(path)
+        if base:
+            remove_previews(base)
+        return
+
+    uploads, previews = preview_outputs(base, video_id, duration) if base else ([], None)
+    finish_job(
+        video_id, [(path, rendition["key"]) for rendition, path in zip(pending, output_paths)] + uploads,
+        output_format=task["output_format"], user_id=user_id, outputs=outputs, **(previews or {})
+    )
+
+
+def upload_segment(path, key):
+    content_type = CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream")
+    upload_output(path, key, ExtraArgs={"ContentType": content_type})
+
+
+def upload_closed_segments(out_dir, prefix, segment_pattern, uploader, uploaded, encoding_done):
+    """Upload each media segment as soon as ffmpeg has closed it."""
+    futures = []
+    while True:
+        finished = encoding_done.wait(0.5)
+        names = sorted(n for n in os.listdir(out_dir) if segment_pattern.match(n))
+
+        # Until ffmpeg exits, hold back the newest segment of each stream in
+        # case the muxer is still writing it in place.
+        if not finished:
+            newest = {re.sub(r"\d+\.\w+$", "", n): n for n in names}
+            names = [n for n in names if n not in newest.values()]
+
+        for name in names:
+            if name in uploaded:
+                continue
+            uploaded.add(name)
+            futures.append(
+                uploader.submit(collect_stages, upload_segment, os.path.join(out_dir, name), f"{prefix}/{name}")
+            )
+        if finished:
+            return futures
+
+
+def process_segmented(task):
+    video_id = task["video_id"]
+    output_format = task["output_format"]
+    filename = task["filename"]
+    user_id = task["user_id"]
+    spec = SEGMENTED_FORMATS[output_format]
+
+    print(f"[INFO] Processing video {video_id} as {output_format} segments")
+    update_api(video_id, "transcoding", 0, user_id=user_id)
+
+    profile_name, profile, _ = resolve_profile(task.get("profile"), output_format)
+    prefix = segmented_prefix(source_etag(task["input_key"]), profile_name, output_format)
+    playlist_key = f"{prefix}/{spec['manifest']}"
+    if object_exists(playlist_key):
+        print(f"[INFO] Cache hit for {video_id}: {playlist_key}")
+        update_api(video_id, "done", 100, output_format, user_id=user_id, playlist_key=playlist_key)
+        return
+
+    input_path = fetch_source(task)
+    info = probe_source(input_path)
+    duration = media_duration(info)
+    base = preview_base() if wants_previews(info, profile) else None
+    previews = {}
+    out_dir = tempfile.mkdtemp()
+    uploaded = set()
+    encoding_done = threading.Event()
+
+    try:
+        with ThreadPoolExecutor(max_workers=SEGMENT_UPLOAD_THREADS) as uploader:
+            watcher = ThreadPoolExecutor(max_workers=1)
+            watch = watcher.submit(
+                upload_closed_segments, out_dir, prefix, spec["segment"], uploader, uploaded, encoding_done
+            )
+
+            reporter = ProgressReporter(video_id, user_id, duration)
+            returncode, tail = run_ffmpeg(
+                ["-i", input_path, *ffmpeg_args(profile), *spec["args"](out_dir),
+                 "-y", os.path.join(out_dir, spec["manifest"]),
+                 *(preview_args(base, duration) if base else [])],
+                reporter
+            )
+            encoding_done.set()
+            segment_uploads = watch.result()
+            watcher.shutdown()
+
+            if returncode != 0:
+                report_failure(video_id, user_id, filename, tail)
+                return
+
+            for future in segment_uploads:
+                add_stages(future.result())
+
+        # Playlists and init segments are only final once ffmpeg has exited
+        for name in sorted(os.listdir(out_dir)):
+            if name not in uploaded and not name.endswith(".tmp"):
+                upload_segment(os.path.join(out_dir, name), f"{prefix}/{name}")
+
+        if base:
+            uploads, previews = preview_outputs(base, video_id, duration)
+            for path, key in uploads:
+                upload_output(path, key, **content_type_args(path))
+
+        print(f"[INFO] Uploaded {len(uploaded)} segments, playlist at {playlist_key}")
+        update_api(
+            video_id, "done", 100, output_format, user_id=user_id, playlist_key=playlist_key, **(previews or {})
+        )
+    finally:
+        os.remove(input_path)
+        if base:
+            remove_previews(base)
+        for name in os.listdir(out_dir):
+            os.remove(os.path.join(out_dir, name))
+        os.rmdir(out_dir)
+
+
+def remove_prefix(prefix):
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=f"{prefix}/"):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=S3_BUCKET, Delete={"Objects": keys})
+
+
+def send_tasks(tasks):
+    # follow-up jobs stay in the lane their parent came from
+    for i in range(0, len(tasks), 10):
+        sqs.send_message_batch(
+            QueueUrl=LANE_QUEUES.get(tasks[i].get("lane"), QUEUE_URL),
+            Entries=[{"Id": str(n), "MessageBody": json.dumps(t)} for n, t in enumerate(tasks[i:i + 10])]
+        )
+
+
+def split_into_chunks(task, input_path, has_audio):
+    """Cut the source's video at keyframes and fan the pieces out as chunk jobs.
+
+    Only the first video stream is split; data tracks (timecode, metadata)
+    can't go into Matroska. The audio is encoded here once, whole, and muxed
+    back in by the concat: encoding it per chunk would add priming samples
+    at every boundary and drift out of sync. Returns False if the source
+    can't be split, so the caller can encode it in one piece instead.
+    """
+    video_id = task["video_id"]
+    chunk_prefix = f"chunks/{video_id}/{uuid.uuid4().hex}"
+    out_dir = tempfile.mkdtemp()
+    _, profile, _ = resolve_profile(task.get("profile"), task["output_format"])
+
+    try:
+        args = [
+            "-i", input_path, "-map", "0:v:0", "-c", "copy",
+            "-f", "segment", "-segment_time", CHUNK_DURATION, "-reset_timestamps", "1",
+            "-segment_format", "matroska", os.path.join(out_dir, "src_%05d.mkv"),
+        ]
+        if has_audio:
+            args += ["-map", "0:a:0", *audio_args(profile), os.path.join(out_dir, "audio.mka")]
+        returncode, tail = run_ffmpeg(args)
+        if returncode != 0:
+            print(f"[WARN] Could not split {video_id} into chunks: {' | '.join(list(tail)[-5:])}")
+            return False
+
+        names = sorted(name for name in os.listdir(out_dir) if name.startswith("src_"))
+        for name in os.listdir(out_dir):
+            upload_output(os.path.join(out_dir, name), f"{chunk_prefix}/{name}")
+    finally:
+        for name in os.listdir(out_dir):
+            os.remove(os.path.join(out_dir, name))
+        os.rmdir(out_dir)
+
+    print(f"[INFO] Split video {video_id} into {len(names)} chunks under {chunk_prefix}")
+    send_tasks([
+        {
+            **task,
+            "job_type": "chunk",
+            "input_key": f"{chunk_prefix}/{name}",
+            "chunk_prefix": chunk_prefix,
+            "chunk_index": index,
+            "chunk_count": len(names),
+            "has_audio": has_audio,
+        }
+        for index, name in enumerate(names)
+    ])
+    return True
+
+
+def process_chunk(task):
+    video_id = task["video_id"]
+    user_id = task["user_id"]
+    chunk_prefix = task["chunk_prefix"]
+    chunk_count = task["chunk_count"]
+
+    input_path = fetch_source(task)
+    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mkv").name
+    _, profile, _ = resolve_profile(task.get("profile"), task["output_format"])
+
+    try:
+        # video only, the concat adds the audio encoded by the split
+        returncode, tail = run_ffmpeg(["-i", input_path, "-map", "0:v:0", *ffmpeg_args(profile), "-an", "-y", output_path])
+        if returncode != 0:
+            report_failure(video_id, user_id, task["filename"], tail)
+            # the video has failed, nothing will concat the other pieces
+            remove_prefix(chunk_prefix)
+            return
+        output_key = f"{chunk_prefix}/out_{task['chunk_index']:05d}.mkv"
+        upload_output(output_path, output_key)
+    finally:
+        os.remove(input_path)
+        os.remove(output_path)
+
+    if not object_exists(task["input_key"]):
+        # another chunk failed and cleaned up while this one was encoding
+        s3.delete_object(Bucket=S3_BUCKET, Key=output_key)
+        return
+
+    listing = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"{chunk_prefix}/out_")
+    finished = listing.get("KeyCount", 0)
+    update_api(video_id, "transcoding", round(finished / chunk_count * 99), user_id=user_id)
+    if finished < chunk_count:
+        return
+
+    # Every chunk that sees the full set enqueues the concat, so a crash
+    # here is fixed by the chunk's own retry; process_concat tolerates the
+    # (rare) duplicates.
+    send_tasks([{**task, "job_type": "concat", "input_key": chunk_prefix}])
+
+
+def process_concat(task):
+    video_id = task["video_id"]
+    user_id = task["user_id"]
+    output_format = task["output_format"]
+    chunk_prefix = task["chunk_prefix"]
+    output_key = task["output_key"]
+
+    # A duplicate of a concat that already finished only has to confirm it
+    if object_exists(output_key):
+        print(f"[INFO] Concat for {video_id} already done: {output_key}")
+        update_api(video_id, "done", 100, output_format, user_id=user_id, output_key=output_key)
+        remove_prefix(chunk_prefix)
+        return
+
+    work_dir = tempfile.mkdtemp()
+    output_path = os.path.join(work_dir, f"output.{output_format}")
+    try:
+        list_path = os.path.join(work_dir, "chunks.txt")
+        with open(list_path, "w") as chunk_list:
+            for index in range(task["chunk_count"]):
+                name = f"out_{index:05d}.mkv"
+                download_to(f"{chunk_prefix}/{name}", os.path.join(work_dir, name))
+                chunk_list.write(f"file '{name}'\n")
+
+        args = ["-f", "concat", "-safe", "0", "-i", list_path]
+        if task.get("has_audio"):
+            audio_path = os.path.join(work_dir, "audio.mka")
+            download_to(f"{chunk_prefix}/audio.mka", audio_path)
+            args += ["-i", audio_path, "-map", "0:v", "-map", "1:a"]
+        else:
+            args += ["-map", "0"]
+        returncode, tail = run_ffmpeg([*args, "-c", "copy", "-y", output_path])
+        if returncode != 0:
+            report_failure(video_id, user_id, task["filename"], tail)
+            remove_prefix(chunk_prefix)
+            return
+
+        print(f"[INFO] Uploading concatenated file to S3: {output_key}")
+        upload_output(output_path, output_key)
+        update_api(video_id, "done", 100, output_format, user_id=user_id, output_key=output_key)
+    finally:
+        for name in os.listdir(work_dir):
+            os.remove(os.path.join(work_dir, name))
+        os.rmdir(work_dir)
+
+    remove_prefix(chunk_prefix)
+
+
+def process_message(task, defer_publish=False, prefetched=None):
+    """Run one job and return its per-stage timings (and, when deferred, what is left to publish).
+
+    prefetched is the pipeline's {"path", "bytes", "stages"} for a source it already
+    downloaded on this host. It is kept out of task so it never ends up in
+    follow-up chunk/concat messages.
+    """
+    _job.stages = list(prefetched["stages"]) if prefetched else []
+    _job.source_path = prefetched["path"] if prefetched else None
+    _job.defer_publish = defer_publish
+    _job.publish = None
+    _job.failed = False
+    try:
+        run_job(task)
+        return {
+            "video_id": task["video_id"],
+            "job_type": task.get("job_type", "transcode"),
+            "outcome": "failed" if _job.failed else "ok",
+            "stages": _job.stages,
+            "publish": _job.publish,
+        }
+    finally:
+        _job.stages = None
+        _job.defer_publish = False
+        _job.source_path = None
+        # jobs that fail or hit the cache return before touching a prefetched source
+        if prefetched and os.path.exists(prefetched["path"]):
+            os.remove(prefetched["path"])
+
+
+def run_job(task):
+    job_type = task.get("job_type")
+    if job_type == "ladder":
+        return process_ladder(task)
+    if job_type == "chunk":
+        return process_chunk(task)
+    if job_type == "concat":
+        return process_concat(task)
+
+    try:
+        profile_name, profile, container = resolve_profile(task.get("profile"), task["output_format"])
+    except ValueError as e:
+        print(f"[ERROR] Rejecting job for {task['video_id']}: {e}")
+        update_api(task["video_id"], "failed", 0, user_id=task["user_id"], error=str(e))
+        return
+    task = {**task, "profile": profile_name, "output_format": container}
+
+    if container in SEGMENTED_FORMATS:
+        return process_segmented(task)
+
     video_id = task["video_id"]
     output_format = task["output_format"]
     filename = task["filename"]
@@ -32,77 +1017,587 @@ def process_message(task):
     user_id = task["user_id"]
 
     print(f"[INFO] Processing video {video_id} in format {output_format}")
-    update_api(video_id, "transcoding", 0)
+    update_api(video_id, "transcoding", 0, user_id=user_id)
 
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_in:
-        s3.download_file(S3_BUCKET, input_key, tmp_in.name)
-        input_path = tmp_in.name
+    output_key = cached_output_key(
+        source_etag(input_key), cache_params(profile_name, output_format), f".{output_format}"
+    )
+    if object_exists(output_key):
+        print(f"[INFO] Cache hit for {video_id}: {output_key}")
+        update_api(video_id, "done", 100, output_format, user_id=user_id, output_key=output_key)
+        return
+
+    if (STREAMING_MODE or task.get("streaming")) and output_format in STREAM_MUXERS:
+        source_url = s3.generate_presigned_url("get_object", Params={"Bucket": S3_BUCKET, "Key": input_key}, ExpiresIn=600)
+        info = probe_source(source_url)
+        remux = profile.get("remux") and can_remux(info, output_format)
+        reporter = ProgressReporter(video_id, user_id, media_duration(info))
+        # fragmented output gets its own movflags from STREAM_MUXERS
+        if stream_transcode(input_key, output_key, output_format, codec_args(remux, profile), reporter):
+            update_api(
+                video_id, "done", 100, output_format, user_id=user_id, output_key=output_key,
+                transcode_path="remux" if remux else "encode"
+            )
+            return
+        # Sources with their index at the end (e.g. phone MOV/MP4) can't be read
+        # from a pipe, so retry those through scratch files.
+        print(f"[INFO] Falling back to file mode for {video_id}")
+
+    input_path = fetch_source(task)
+    info = probe_source(input_path)
+    duration = media_duration(info)
+    remux = profile.get("remux") and can_remux(info, output_format)
+    chunkable = output_format in CHUNKABLE_FORMATS and not profile.get("audio_only")
+
+    if not remux and chunkable and CHUNKED_MIN_DURATION and duration and duration >= CHUNKED_MIN_DURATION:
+        has_audio = any(st.get("codec_type") == "audio" for st in info.get("streams", []))
+        try:
+            split = split_into_chunks({**task, "output_key": output_key}, input_path, has_audio)
+        except Exception:
+            os.remove(input_path)
+            raise
+        if split:
+            os.remove(input_path)
+            return
+        print(f"[INFO] Encoding {video_id} on this worker instead")
 
     output_path = tempfile.NamedTemporaryFile(delete=False, suffix=f".{output_format}").name
-    output_key = f"transcoded/{filename}_{output_format}.{output_format}"
+    args = ["-i", input_path, *codec_args(remux, profile, output_format), "-y", output_path]
+
+    base = preview_base() if wants_previews(info, profile) else None
+    if base:
+        args += preview_args(base, duration)
+        if remux:
+            # stream copy skips the decoder, so only decode keyframes for the previews
+            args = ["-skip_frame", "nokey", *args]
 
-    process = subprocess.run(
-        ["ffmpeg", "-i", input_path, "-c:v", "libx264", "-c:a", "aac", "-y", output_path],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    reporter = ProgressReporter(video_id, user_id, duration)
+    if remux:
+        print(f"[INFO] Source of {video_id} already matches the target codecs, remuxing")
+    try:
+        returncode, tail = run_ffmpeg(args, reporter)
+    finally:
+        os.remove(input_path)
+
+    if returncode != 0:
+        report_failure(video_id, user_id, filename, tail)
+        os.remove(output_path)
+        if base:
+            remove_previews(base)
+        return
+
+    uploads, previews = preview_outputs(base, video_id, duration) if base else ([], None)
+    finish_job(
+        video_id, [(output_path, output_key), *uploads],
+        output_format=output_format, user_id=user_id, output_key=output_key,
+        transcode_path="remux" if remux else "encode", **(previews or {})
     )
 
-    if process.returncode == 0:
-        print(f"[INFO] Uploading transcoded file to S3: {output_key}")
-        s3.upload_file(output_path, S3_BUCKET, output_key)
-        update_api(video_id, "done", 100, output_format)
-    else:
-        print(f"[ERROR] ffmpeg failed for {filename}: {process.stderr[:200]}")
-        update_api(video_id, "failed", 0)
 
-    os.remove(input_path)
-    os.remove(output_path)
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    # Prefer the container (cgroup v2) limit over the host total
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            return int(limit) // (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
 
-def poll_queue():
+def job_slots():
+    if WORKER_CONCURRENCY not in ("auto", "adaptive"):
+        return max(1, int(WORKER_CONCURRENCY))
+
+    slots = available_cores()
+    memory_mb = available_memory_mb()
+    if memory_mb:
+        slots = min(slots, memory_mb // JOB_MEMORY_MB)
+    return max(1, slots)
+
+
+def cpu_limit():
+    # cgroup v2 quota ("max 100000" when unlimited)
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return min(available_cores(), int(quota) / int(period))
+    except (OSError, ValueError):
+        pass
+    return available_cores()
+
+
+def cpu_seconds():
+    """CPU time used so far by this container, or by the whole host without cgroup v2."""
+    try:
+        with open("/sys/fs/cgroup/cpu.stat") as f:
+            for line in f:
+                name, value = line.split()
+                if name == "usage_usec":
+                    return int(value) / 1_000_000
+    except (OSError, ValueError):
+        pass
+    with open("/proc/stat") as f:
+        fields = [int(v) for v in f.readline().split()[1:]]
+    # everything but idle and iowait
+    busy = sum(fields) - fields[3] - (fields[4] if len(fields) > 4 else 0)
+    return busy / os.sysconf("SC_CLK_TCK")
+
+
+def memory_headroom_mb():
+    """Memory left before the container limit, not counting reclaimable page cache."""
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            with open("/sys/fs/cgroup/memory.current") as f:
+                used = int(f.read())
+            with open("/sys/fs/cgroup/memory.stat") as f:
+                stat = dict(line.split() for line in f)
+            used -= int(stat.get("inactive_file", 0))
+            return (int(limit) - used) // (1024 * 1024)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = {line.split(":")[0]: line.split()[1] for line in f}
+        return int(meminfo["MemAvailable"]) // 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class ConcurrencyController:
+    """Moves the number of concurrent jobs with CPU use, memory headroom and encode speed."""
+
+    def __init__(self, initial, minimum=CONCURRENCY_MIN, maximum=None, interval=CONCURRENCY_INTERVAL):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or CONCURRENCY_MAX or 2 * available_cores())
+        self.target = min(max(initial, self.minimum), self.maximum)
+        self.interval = interval
+        self.running = 0
+        self.votes = 0
+        self.ceiling = None
+        self.speeds = []
+        self.speed_at = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        metrics.CONCURRENCY_TARGET.set(self.target)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def observe(self, result):
+        """Record per-job encode speed (media seconds per wall second) from a finished job."""
+        with self.lock:
+            for stage in result["stages"]:
+                if stage["stage"] in ("encode", "stream") and stage["media_seconds"] and stage["seconds"] > 0:
+                    self.speeds.append(stage["media_seconds"] / stage["seconds"])
+
+    def _run(self):
+        last_cpu, last_time = cpu_seconds(), time.monotonic()
+        while not self.stopped.wait(self.interval):
+            now_cpu, now = cpu_seconds(), time.monotonic()
+            utilization = (now_cpu - last_cpu) / ((now - last_time) * cpu_limit())
+            last_cpu, last_time = now_cpu, now
+            metrics.CPU_UTILIZATION.set(round(utilization, 3))
+            self.adjust(utilization, memory_headroom_mb())
+
+    def adjust(self, utilization, headroom_mb):
+        with self.lock:
+            if self.speeds:
+                self.speed_at[self.target] = sum(self.speeds) / len(self.speeds)
+                self.speeds = []
+            if self.ceiling and time.monotonic() > self.ceiling[1]:
+                self.ceiling = None
+
+            throughput = {n: n * speed for n, speed in self.speed_at.items()}
+            lost_throughput = (
+                self.target in throughput and self.target - 1 in throughput
+                and throughput[self.target] < throughput[self.target - 1]
+            )
+
+            if headroom_mb is not None and headroom_mb < JOB_MEMORY_MB // 2:
+                # running out of memory can't wait for a second vote
+                self.votes = -CONCURRENCY_PATIENCE
+            elif utilization > CONCURRENCY_CPU_HIGH and lost_throughput:
+                self.votes = min(self.votes, 0) - 1
+            elif (
+                utilization < CONCURRENCY_CPU_LOW and self.running >= self.target
+                and (headroom_mb is None or headroom_mb > JOB_MEMORY_MB)
+                and not (self.ceiling and self.target + 1 >= self.ceiling[0])
+            ):
+                self.votes = max(self.votes, 0) + 1
+            else:
+                self.votes = 0
+
+            if abs(self.votes) < CONCURRENCY_PATIENCE:
+                return
+            step = 1 if self.votes > 0 else -1
+            target = min(max(self.target + step, self.minimum), self.maximum)
+            self.votes = 0
+            if target == self.target:
+                return
+            if step < 0 and lost_throughput:
+                self.ceiling = (self.target, time.monotonic() + CONCURRENCY_CEILING_TTL)
+            print(
+                f"[INFO] Concurrency {self.target} -> {target} "
+                f"(cpu {utilization:.0%}, memory headroom {headroom_mb} MB)"
+            )
+            self.target = target
+            metrics.CONCURRENCY_TARGET.set(target)
+
+
+def concurrency(slots):
+    """Controller for the runtimes: fixed when slots is given or the mode isn't adaptive."""
+    if slots or WORKER_CONCURRENCY != "adaptive":
+        slots = slots or job_slots()
+        return ConcurrencyController(slots, minimum=slots, maximum=slots)
+    controller = ConcurrencyController(job_slots())
+    controller.start()
+    return controller
+
+
+def validate_task(msg):
     required_fields = ["video_id", "output_format", "filename", "input_key"]
+    task = json.loads(msg["Body"])
 
-    while True:
+    if not all(field in task for field in required_fields):
+        metrics.JOBS.inc(job_type=task.get("job_type", "transcode"), outcome="invalid")
+        update_api(task.get("video_id"), "Cannot process, upload again", 0, user_id=task.get("user_id"))
+        return None
+    return task
+
+
+def delete_message(msg):
+    sqs.delete_message(
+        QueueUrl=msg.get("QueueUrl", QUEUE_URL),
+        ReceiptHandle=msg["ReceiptHandle"]
+    )
+
+
+def lane_poll_order():
+    """Distinct lane queues in a weighted random order."""
+    weights = {}
+    for lane, queue_url in LANE_QUEUES.items():
+        weights[queue_url] = weights.get(queue_url, 0) + LANE_WEIGHTS.get(lane, 1)
+
+    order = []
+    while weights:
+        queue_url = random.choices(list(weights), weights=list(weights.values()))[0]
+        order.append(queue_url)
+        del weights[queue_url]
+    return order
+
+
+def receive_messages(max_messages, wait_seconds):
+    order = lane_poll_order()
+    for queue_url in order:
+        started = time.monotonic()
         response = sqs.receive_message(
-            QueueUrl=QUEUE_URL,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=20,
-            VisibilityTimeout=900
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=max_messages,
+            # Earlier lanes are checked without waiting so they aren't hidden
+            # behind a long poll; the last one waits, so callers never spin
+            WaitTimeSeconds=wait_seconds if queue_url == order[-1] else 0,
+            VisibilityTimeout=VISIBILITY_TIMEOUT
         )
-
         messages = response.get('Messages', [])
-
+        metrics.QUEUE_RECEIVE_SECONDS.observe(
+            time.monotonic() - started, result="messages" if messages else "empty"
+        )
         if messages:
             for msg in messages:
-                try:
-                    task = json.loads(msg["Body"])
+                msg["QueueUrl"] = queue_url
+            return messages
+    return []
 
-                    # Validate message
-                    if not all(field in task for field in required_fields):
-                        update_api(task.get("video_id"), "Cannot process, upload again", 0)
-                        continue
 
-                    # Process valid message
-                    process_message(task)
-                    sqs.delete_message(
-                        QueueUrl=QUEUE_URL,
-                        ReceiptHandle=msg["ReceiptHandle"]
-                    )
+class VisibilityHeartbeat:
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=VISIBILITY_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.receipts = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, msg):
+        with self.lock:
+            self.receipts[msg["MessageId"]] = (msg.get("QueueUrl", QUEUE_URL), msg["ReceiptHandle"])
+            metrics.JOBS_IN_FLIGHT.set(len(self.receipts))
+
+    def remove(self, msg):
+        with self.lock:
+            self.receipts.pop(msg["MessageId"], None)
+            metrics.JOBS_IN_FLIGHT.set(len(self.receipts))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            by_queue = {}
+            with self.lock:
+                for queue_url, receipt in self.receipts.values():
+                    by_queue.setdefault(queue_url, []).append(receipt)
+
+            for queue_url, receipts in by_queue.items():
+                # change_message_visibility_batch takes at most 10 entries per call
+                for i in range(0, len(receipts), 10):
+                    batch = [
+                        {"Id": str(n), "ReceiptHandle": receipt, "VisibilityTimeout": self.timeout}
+                        for n, receipt in enumerate(receipts[i:i + 10])
+                    ]
+                    try:
+                        resp = sqs.change_message_visibility_batch(QueueUrl=queue_url, Entries=batch)
+                        for failed in resp.get("Failed", []):
+                            print(f"[WARN] Failed to extend visibility: {failed.get('Message')}")
+                    except Exception as e:
+                        print(f"[WARN] Visibility heartbeat failed: {e}")
+
+
+def poll_queue(executor=None, slots=None, stop_when_idle=False):
+    controller = concurrency(slots)
+    print(f"[INFO] Worker running with {controller.target} concurrent job slot(s), at most {controller.maximum}")
+
+    # spawn so every job process builds its own boto3 clients
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=controller.maximum, mp_context=multiprocessing.get_context("spawn")
+        )
+    in_flight = {}
+    heartbeat = VisibilityHeartbeat()
+    heartbeat.start()
+
+    while True:
+        slots = controller.target
+        controller.running = len(in_flight)
+        free_slots = slots - len(in_flight)
+
+        if free_slots > 0:
+            # Only long-poll when there is nothing running that needs reaping
+            messages = receive_messages(min(MAX_MESSAGES_PER_POLL, free_slots), 1 if in_flight else 20)
+
+            for msg in messages:
+                try:
+                    task = validate_task(msg)
+                    if task is None:
+                        continue
+                    heartbeat.add(msg)
+                    in_flight[executor.submit(process_message, task)] = msg
                 except Exception as e:
                     print(f"[ERROR] Failed to process message: {e}")
-        else:
-            print("[INFO] No messages available. Sleeping 10s.")
-            time.sleep(10)
 
+            if not messages and not in_flight:
+                if stop_when_idle:
+                    heartbeat.stop()
+                    controller.stop()
+                    return
+                print("[INFO] No messages available. Sleeping 10s.")
+                time.sleep(10)
+                continue
 
-if __name__ == "__main__":
-    poll_queue()
+        if not in_flight:
+            continue
+
+        # Block only when every slot is busy, otherwise just reap what has finished.
+        # Wake up every controller interval in case the target has been raised.
+        done, _ = wait(
+            in_flight, timeout=controller.interval if len(in_flight) >= slots else 0, return_when=FIRST_COMPLETED
+        )
+
+        for future in done:
+            msg = in_flight.pop(future)
+            heartbeat.remove(msg)
+            try:
+                result = future.result()
+                delete_message(msg)
+            except Exception as e:
+                print(f"[ERROR] Failed to process message: {e}")
+                metrics.JOBS.inc(job_type=json.loads(msg["Body"]).get("job_type", "transcode"), outcome="error")
+                continue
+
+            metrics.observe_job(result)
+            controller.observe(result)
+            for hook in JOB_HOOKS:
+                hook(result)
+
+
+def prefetchable(task):
+    if task.get("job_type") == "concat":
+        return False
+    return not (STREAMING_MODE or task.get("streaming"))
+
+
+def prefetch_source(task):
+    # A repeat job is answered by a HEAD on its cached output, don't download for it
+    if outputs_cached(task):
+        return None
+    _job.stages = []
+    try:
+        source_path = download_source(task["input_key"])
+        # a source cache hit records no download stage
+        return {"path": source_path, "bytes": os.path.getsize(source_path), "stages": _job.stages}
+    finally:
+        _job.stages = None
+
+
+def publish_result(result):
+    # publish() runs in an upload thread, so collect its stages into the job's result
+    _job.stages = result["stages"]
+    try:
+        publish(*result["publish"])
+    finally:
+        _job.stages = None
+    return result
+
+
+def run_pipeline(executor=None, slots=None, stop_when_idle=False):
+    """Overlap the next jobs' downloads and the previous jobs' uploads with the current encodes."""
+    controller = concurrency(slots)
+    print(
+        f"[INFO] Pipelined worker running with {controller.target} encode slot(s), at most {controller.maximum}, "
+        f"prefetch depth {PREFETCH_DEPTH}"
+    )
+
+    if executor is None:
+        executor = ProcessPoolExecutor(
+            max_workers=controller.maximum, mp_context=multiprocessing.get_context("spawn")
+        )
+    fetcher = ThreadPoolExecutor(max_workers=PREFETCH_DEPTH)
+    uploader = ThreadPoolExecutor(max_workers=UPLOAD_THREADS)
+    heartbeat = VisibilityHeartbeat()
+    heartbeat.start()
+
+    fetching, encoding, uploading = {}, {}, {}
+    ready = deque()
+    scratch_bytes = 0
+    scratch_budget = PREFETCH_SCRATCH_MB * 1024 * 1024
+
+    def finish(msg, result):
+        heartbeat.remove(msg)
+        delete_message(msg)
+        metrics.observe_job(result)
+        controller.observe(result)
+        for hook in JOB_HOOKS:
+            hook(result)
+
+    while True:
+        slots = controller.target
+        controller.running = len(encoding)
+        while ready and len(encoding) < slots:
+            msg, task, prefetched = ready.popleft()
+            encoding[executor.submit(process_message, task, True, prefetched)] = (msg, task, prefetched)
 
+        # Keep every encode slot busy plus PREFETCH_DEPTH sources waiting on disk
+        waiting = len(fetching) + len(ready)
+        wanted = max(0, slots - len(encoding)) + PREFETCH_DEPTH - waiting
+        if scratch_bytes >= scratch_budget and waiting:
+            wanted = 0
 
+        messages = []
+        if wanted > 0:
+            busy = fetching or encoding or uploading or ready
+            messages = receive_messages(min(MAX_MESSAGES_PER_POLL, wanted), 1 if busy else 20)
 
+        for msg in messages:
+            try:
+                task = validate_task(msg)
+                if task is None:
+                    continue
+                heartbeat.add(msg)
+                if prefetchable(task):
+                    fetching[fetcher.submit(prefetch_source, task)] = (msg, task)
+                else:
+                    ready.append((msg, task, None))
+            except Exception as e:
+                print(f"[ERROR] Failed to process message: {e}")
 
+        pending = {**fetching, **encoding, **uploading}
+        if not pending:
+            if ready:
+                continue
+            if stop_when_idle and not messages:
+                heartbeat.stop()
+                controller.stop()
+                return
+            if not messages:
+                print("[INFO] No messages available. Sleeping 10s.")
+                time.sleep(10)
+            continue
 
+        # Block only when there is nothing more to receive, waking up every
+        # controller interval in case the target has been raised
+        done, _ = wait(pending, timeout=controller.interval if wanted <= 0 else 0, return_when=FIRST_COMPLETED)
 
+        for future in done:
+            if future in fetching:
+                msg, task = fetching.pop(future)
+                prefetched = None
+                try:
+                    prefetched = future.result()
+                    if prefetched:
+                        scratch_bytes += prefetched["bytes"]
+                except Exception as e:
+                    # let the job download for itself
+                    print(f"[WARN] Prefetch failed for {task['video_id']}: {e}")
+                ready.append((msg, task, prefetched))
+
+            elif future in encoding:
+                msg, task, prefetched = encoding.pop(future)
+                if prefetched:
+                    scratch_bytes -= prefetched["bytes"]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"[ERROR] Failed to process message: {e}")
+                    metrics.JOBS.inc(job_type=task.get("job_type", "transcode"), outcome="error")
+                    heartbeat.remove(msg)
+                    continue
+                if result["publish"]:
+                    uploading[uploader.submit(publish_result, result)] = (msg, task)
+                else:
+                    finish(msg, result)
 
+            else:
+                msg, task = uploading.pop(future)
+                try:
+                    finish(msg, future.result())
+                except Exception as e:
+                    print(f"[ERROR] Failed to upload outputs for {task['video_id']}: {e}")
+                    metrics.JOBS.inc(job_type=task.get("job_type", "transcode"), outcome="error")
+                    heartbeat.remove(msg)
 
 
+if __name__ == "__main__":
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    if METRICS_FILE:
+        metrics.write_snapshots(METRICS_FILE, METRICS_SNAPSHOT_INTERVAL)
 
-       
\ No newline at end of file
+    if PIPELINE_MODE:
+        run_pipeline()
+    else:
+        poll_queue()
@@ -238,8 +238,9 @@ async def dashboard(request: Request):
 
     headers = {"Authorization": f"Bearer {access_token}"}
     videos, tasks = [], []
+    next_cursor = None
 
-    skip = int(request.query_params.get("skip", 0))
+    cursor = request.query_params.get("cursor")
     limit = int(request.query_params.get("limit", 10))
     sort_by = request.query_params.get("sort_by", "created_at")
     order = request.query_params.get("order", "desc")
@@ -248,7 +249,7 @@ async def dashboard(request: Request):
     search = request.query_params.get("search")
 
     logging.info(
-        f"Query params → skip={skip}, limit={limit}, sort_by={sort_by}, "
+        f"Query params → cursor={cursor}, limit={limit}, sort_by={sort_by}, "
         f"order={order}, status={status}, owner={owner_filter}, search={search}"
     )
 
@@ -256,7 +257,7 @@ async def dashboard(request: Request):
         timeout = httpx.Timeout(60.0, connect=30.0)
         async with httpx.AsyncClient(timeout=timeout) as client:
             params = {
-                "skip": skip,
+                "cursor": cursor,
                 "limit": limit,
                 "sort_by": sort_by,
                 "order": order,
@@ -270,6 +271,7 @@ async def dashboard(request: Request):
 
             resp_json = resp.json()
             all_videos = resp_json.get("items", [])
+            next_cursor = resp_json.get("next_cursor")
             logging.info(f"Fetched {len(all_videos)} total videos from API")
 
             if role == "admin":
@@ -293,7 +295,8 @@ async def dashboard(request: Request):
             "username": username,
             "role": role,
             "tasks": tasks,
-            "skip": skip,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
             "limit": limit,
             "sort_by": sort_by,
             "order": order,
@@ -516,12 +519,37 @@ async def download(request: Request, video_id: str):
         if resp.status_code != 200:
             return RedirectResponse(f"/web/dashboard", status_code=303)
         data = resp.json()
+        if data.get("playlist_url"):
+            return RedirectResponse(f"/web/playlist/{video_id}")
+
         download_url = data.get("download_url")
         if not download_url:
             return RedirectResponse(f"/web/dashboard", status_code=303)
 
         return RedirectResponse(download_url)
 
+
+@app.get("/playlist/{video_id}")
+async def playlist(request: Request, video_id: str):
+    id_token = request.cookies.get("session_token")
+    access_token = request.cookies.get("access_token")
+
+    if not id_token:
+        logging.warning("No IdToken found in cookies")
+        return RedirectResponse("/web/web", status_code=303)
+
+    if not access_token:
+        logging.warning("No AccessToken found in cookies; using IdToken as fallback")
+        access_token = id_token
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    async with httpx.AsyncClient() as client:
+        resp = await client.get(f"{API_BASE}/videos/{video_id}/playlist", headers=headers)
+        if resp.status_code != 200:
+            return RedirectResponse(f"/web/dashboard", status_code=303)
+
+        return Response(resp.content, media_type=resp.headers.get("content-type"))
+
 # --- MFA routes ---
 @app.get("/mfa", response_class=HTMLResponse)
 async def mfa_page(request: Request):
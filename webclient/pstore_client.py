@@ -1,32 +1,95 @@
+import json
+import os
+import tempfile
+import threading
+import time
 import boto3
 import logging
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 logging.basicConfig(level=logging.INFO)
 
-def load_parameters(names=None, region_name="ap-southeast-2"):
-    if names is None:
-        names = [
-            "/n11715910/awsregion",
-            "/n11715910/cognitouserpoolid",
-            "/n11715910/cognitoclientid",
-            "/n11715910/domain",
-            "/n11715910/redirecturl",
-            "/n11715910/s3bucket",
-            "/n11715910/cognitodomain",
-        ]
+PREFIX = "/n11715910/"
+DEFAULT_NAMES = [
+    "/n11715910/awsregion",
+    "/n11715910/cognitouserpoolid",
+    "/n11715910/cognitoclientid",
+    "/n11715910/domain",
+    "/n11715910/cognitodomain",
+    "/n11715910/redirecturl",
+    "/n11715910/s3bucket",
+]
+
+# Parameters are loaded once per process, and a snapshot on disk lets a
+# restarted container skip SSM for PARAMETER_CACHE_TTL seconds. An older
+# snapshot is still used if SSM can't be reached.
+CACHE_FILE = os.environ.get(
+    "PARAMETER_CACHE_FILE", os.path.join(tempfile.gettempdir(), "n11715910-parameters.json")
+)
+CACHE_TTL = float(os.environ.get("PARAMETER_CACHE_TTL", 3600))
+BATCH_SIZE = 10  # most names one GetParameters call accepts
+
+_lock = threading.Lock()
+_loaded = {}
+
+
+def _read_snapshot(names, region_name, max_age=None):
+    try:
+        with open(CACHE_FILE) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("names") != list(names) or snapshot.get("region") != region_name:
+        return None
+    if max_age is not None and time.time() - snapshot.get("saved_at", 0) > max_age:
+        return None
+    return snapshot["params"]
+
+
+def _write_snapshot(names, region_name, params):
+    try:
+        tmp = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"names": list(names), "region": region_name, "saved_at": time.time(), "params": params}, f)
+        os.replace(tmp, CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Could not write parameter snapshot {CACHE_FILE}: {e}")
 
+
+def _fetch(names, region_name):
     ssm = boto3.client("ssm", region_name=region_name)
     params = {}
+    missing = []
+
+    for i in range(0, len(names), BATCH_SIZE):
+        response = ssm.get_parameters(Names=list(names[i:i + BATCH_SIZE]))
+        for parameter in response["Parameters"]:
+            params[parameter["Name"].replace(PREFIX, "")] = parameter["Value"]
+        missing.extend(response.get("InvalidParameters", []))
+
+    for name in missing:
+        logging.error(f"Failed to load parameter {name}: not found")
+    return params, not missing
+
+
+def load_parameters(names=None, region_name="ap-southeast-2"):
+    names = tuple(names or DEFAULT_NAMES)
+    key = (names, region_name)
+
+    with _lock:
+        if key not in _loaded:
+            params = _read_snapshot(names, region_name, max_age=CACHE_TTL)
+            if params is None:
+                try:
+                    params, complete = _fetch(names, region_name)
+                    if complete:
+                        _write_snapshot(names, region_name, params)
+                except (BotoCoreError, ClientError) as e:
+                    logging.error(f"Failed to load parameters: {e}")
+                    params = _read_snapshot(names, region_name)
+                    if params is None:
+                        return {}  # not memoized, so the next call tries SSM again
+                    logging.warning(f"Using stale parameter snapshot {CACHE_FILE}")
+            _loaded[key] = params
 
-    for name in names:
-        try:
-            response = ssm.get_parameter(
-                Name=name 
-            )
-            key = name.replace("/n11715910/", "")
-            params[key] = response["Parameter"]["Value"]
-        except ClientError as e:
-            logging.error(f"Failed to load parameter {name}: {e}")
-
-    return params
\ No newline at end of file
+        return dict(_loaded[key])